@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import codecs
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from utils import MAN2HTML
+from cache import ConversionCache, DEFAULT_MAX_SIZE
+from xref import PageIndex, split_page_name
+from search import SectionCollector, SearchIndex
+from ir import parse, render_html
+from compact import CompactMAN2HTML, STYLESHEET_NAME, stylesheet
+from pageio import COMPRESSION_SUFFIXES, open_page, read_page, decode_lines
+from sinks import BUNDLE_SINKS, DirectorySink, EntrySink, open_sink
+
+CHUNKS_PER_WORKER = 8
+MAX_CHUNK_SIZE = 64
+CACHE_TRIM_INTERVAL = 64
+
+_converter = None
+_styles = ''
+_cache = None
+_output = None
+_sink = None
+_indexer = None
+_encoding = None
+
+
+def get_arguments():
+    parser = ArgumentParser()
+    parser.add_argument('sources', metavar='DIR', nargs='*',
+                        help='Man hierarchy to convert (e.g. /usr/share/man)')
+    parser.add_argument('-m', '--manifest', dest='manifest', metavar='FILE',
+                        help='File with one page path per line')
+    parser.add_argument('-o', '--output', dest='output', metavar='DIR',
+                        help='Output directory, or a bundle file '
+                             '(pages.zip, pages.sqlite)', required=True)
+    parser.add_argument('-s', '--style', dest='style', metavar='FILE',
+                        help='Styles file (e.g. style.css)')
+    parser.add_argument('-e', '--encoding', dest='encoding',
+                        help='Encoding of all pages (default: detected per '
+                             'page)')
+    parser.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int,
+                        help='Number of worker processes (default: all cores)')
+    parser.add_argument('-c', '--cache', dest='cache', metavar='DIR',
+                        help='Conversion cache directory')
+    parser.add_argument('--cache-size', dest='cache_size', metavar='MB',
+                        type=int, default=DEFAULT_MAX_SIZE >> 20,
+                        help='Conversion cache size limit in megabytes')
+    parser.add_argument('-x', '--xref', dest='xref', metavar='FILE',
+                        help='Build a page index into FILE and link '
+                             'name(N) references only to existing pages')
+    parser.add_argument('-S', '--search', dest='search', metavar='FILE',
+                        help='Build a full-text search index into FILE')
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help='Use short class names and write the styles '
+                             'once into man.css')
+    parser.add_argument('-z', '--compress', dest='compress',
+                        action='store_true',
+                        help='Write gzipped pages (ls.1.html.gz)')
+    parser.add_argument('-k', '--keep-uncompressed', dest='keep',
+                        action='store_true',
+                        help='Write uncompressed pages next to the gzipped '
+                             'ones')
+    args = parser.parse_args()
+    if args.encoding:
+        try:
+            codecs.lookup(args.encoding)
+        except LookupError:
+            parser.error('unknown encoding {}'.format(args.encoding))
+    if not args.sources and not args.manifest:
+        parser.error('at least one DIR or --manifest is required')
+    if args.compress and os.path.splitext(args.output)[1] in BUNDLE_SINKS:
+        parser.error('bundle entries are always compressed, '
+                     '--compress applies to directory output only')
+    return args
+
+
+def strip_compression(filename):
+    for suffix in COMPRESSION_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def page_name(filename):
+    return strip_compression(filename) + '.html'
+
+
+def page_path(target, output):
+    return os.path.relpath(target, output).replace(os.sep, '/')
+
+
+def index_pages(tasks, output):
+    for source, target in tasks:
+        parts = split_page_name(strip_compression(os.path.basename(source)))
+        if parts is not None:
+            yield parts + (page_path(target, output),)
+
+
+def is_section(directory):
+    name = os.path.basename(os.path.normpath(directory))
+    return name.startswith('man') and len(name) > 3
+
+
+def source_base(source):
+    return os.path.dirname(os.path.normpath(source)) \
+        if is_section(source) else source
+
+
+def collect_pages(sources, output):
+    for source in sources:
+        base = source_base(source)
+        for directory, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            if not is_section(directory):
+                continue
+            relative = os.path.relpath(directory, base)
+            for filename in sorted(filenames):
+                yield (os.path.join(directory, filename),
+                       os.path.join(output, relative, page_name(filename)))
+
+
+def page_target(sources, path, output):
+    directory, filename = os.path.split(path)
+    if not is_section(directory):
+        return None
+    target = None
+    for source in sources:
+        relative = os.path.relpath(directory, source)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            continue
+        target = os.path.join(
+            output, os.path.relpath(directory, source_base(source)),
+            page_name(filename))
+    return target
+
+
+def collect_manifest(manifest, output):
+    with open(manifest) as f:
+        for line in f:
+            filename = line.strip()
+            if not filename:
+                continue
+            section = os.path.basename(os.path.dirname(filename))
+            yield (filename, os.path.join(
+                output, section, page_name(os.path.basename(filename))))
+
+
+def _init_worker(styles, cache_directory, output, xref_filename,
+                 compress=(False, False), search=False, compact=False,
+                 bundle=False, encoding=None):
+    global _converter, _styles, _cache, _output, _sink, _indexer, _encoding
+    xref = None if xref_filename is None else PageIndex(xref_filename)
+    _indexer = SectionCollector() if search else None
+    converter_class = CompactMAN2HTML if compact else MAN2HTML
+    _converter = converter_class(xref=xref, indexer=_indexer)
+    _styles = styles
+    _output = output
+    _encoding = encoding
+    _sink = EntrySink() if bundle else DirectorySink(output, *compress)
+    if cache_directory is not None:
+        _cache = ConversionCache(cache_directory, max_size=None)
+
+
+def _convert_cached(source, f):
+    page = read_page(source)
+    key = _cache.key(page, rules=_converter.rules_version(),
+                     encoding=_encoding)
+    document = _cache.get_document(key) if _indexer is None else None
+    hit = document is not None
+    if not hit:
+        document = parse(_converter, decode_lines(page, _encoding))
+        _cache.put_document(key, document)
+    f.write(render_html(_converter, document, _styles))
+    return hit
+
+
+def convert_page(task):
+    source, target = task
+    path = page_path(target, _output)
+    _converter.reset(page_path=path)
+    hit = False
+    try:
+        with _sink.open(path) as f:
+            if _cache is not None:
+                hit = _convert_cached(source, f)
+            else:
+                with open_page(source, _encoding) as lines:
+                    _converter.man2html_stream(lines, f, styles=_styles)
+    except Exception as error:
+        _sink.remove(path)
+        return source, '{}: {}'.format(type(error).__name__, error), hit, \
+            None, ()
+    records = None
+    if _indexer is not None:
+        name = strip_compression(os.path.basename(source))
+        name, section = split_page_name(name) or (name, '')
+        records = _indexer.finish_page(path, name, section)
+    return source, None, hit, records, _sink.drain()
+
+
+def convert_pages(tasks, styles='', jobs=None, cache_directory=None,
+                  output='', xref_filename=None, compress=False,
+                  keep=False, search=False, compact=False, bundle=False,
+                  encoding=None):
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, min(MAX_CHUNK_SIZE,
+                           len(tasks) // (jobs * CHUNKS_PER_WORKER)))
+    initargs = (styles, cache_directory, output, xref_filename,
+                (compress, keep), search, compact, bundle, encoding)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=initargs) as executor:
+        for result in executor.map(convert_page, tasks, chunksize=chunksize):
+            yield result
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if arguments.style:
+        with open(arguments.style) as f:
+            styles = f.read()
+    else:
+        styles = ''
+    tasks = list(collect_pages(arguments.sources, arguments.output))
+    if arguments.manifest:
+        tasks.extend(collect_manifest(arguments.manifest, arguments.output))
+    if arguments.xref:
+        PageIndex.build(arguments.xref, index_pages(tasks, arguments.output))
+    sink = open_sink(arguments.output, arguments.compress, arguments.keep)
+    if arguments.compact:
+        sink.write(STYLESHEET_NAME, stylesheet(styles))
+        styles = ''
+    index = SearchIndex(arguments.search) if arguments.search else None
+    cache = ConversionCache(arguments.cache, arguments.cache_size << 20) \
+        if arguments.cache else None
+    failed = hits = misses = 0
+    with sink:
+        for source, error, hit, records, entries in convert_pages(
+                tasks, styles, arguments.jobs, arguments.cache,
+                arguments.output, arguments.xref, arguments.compress,
+                arguments.keep, index is not None, arguments.compact,
+                sink.bundle, arguments.encoding):
+            hits += hit
+            if cache is not None and not hit:
+                misses += 1
+                if misses % CACHE_TRIM_INTERVAL == 0:
+                    cache.trim()
+            for path, entry in entries:
+                sink.write_entry(path, entry)
+            if records is not None:
+                index.add_page(*records)
+            if error is not None:
+                failed += 1
+                sys.stderr.write('{}: {}\n'.format(source, error))
+    sys.stderr.write('converted {} of {} pages\n'.format(
+        len(tasks) - failed, len(tasks)))
+    if index is not None:
+        index.commit()
+        index.optimize()
+        index.close()
+    if cache is not None:
+        cache.trim()
+        sys.stderr.write('cache: {} hits, {} misses, {} evicted\n'.format(
+            hits, len(tasks) - hits, cache.evictions))
+    sys.exit(1 if failed else 0)
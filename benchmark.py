@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import glob
+import json
+import time
+import timeit
+import statistics
+import tempfile
+import tracemalloc
+from functools import partial
+from collections import deque
+from argparse import ArgumentParser
+from utils import MAN2HTML, _alternation
+from profiling import StageProfiler
+from pageio import open_page, read_page as read_page_bytes
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench_corpus')
+MODES = ('man2html_base', 'man2html')
+STAGES = MAN2HTML.STAGES
+PAGE_TITLE = '.TH SYNTHETIC 1 "2020-01-01" "1.0" "Benchmark"'
+FONT_ESCAPES_UNIT = r'\fBbold\fR text \fIitalic\fP '
+REFERENCE_ITERATIONS = 40000
+
+
+def get_arguments():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=9,
+                        help='Runs per measurement (best one is reported)')
+    parser.add_argument('-l', '--lines', dest='lines', type=int,
+                        default=5000, help='Lines per synthetic page')
+    parser.add_argument('-c', '--corpus', dest='corpus', metavar='DIR',
+                        action='append', default=[],
+                        help='Additional directory with man pages')
+    parser.add_argument('-j', '--json', dest='json', metavar='FILE',
+                        help='Write the results as json into FILE')
+    parser.add_argument('-b', '--baseline', dest='baseline', metavar='FILE',
+                        help='Compare against results stored by --json')
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float,
+                        default=0.2, help='Allowed throughput loss against '
+                                          'the baseline (default: 0.2)')
+    args = parser.parse_args()
+    return args
+
+
+def font_escapes_page(lines_count):
+    yield PAGE_TITLE
+    for i in range(lines_count):
+        yield FONT_ESCAPES_UNIT * (1 + i % 8) + r'\s+2big\s-2 \fB\f(CWcode\fP'
+
+
+def ip_list_page(lines_count):
+    yield PAGE_TITLE
+    yield '.SH "OPTIONS"'
+    for i in range(lines_count // 3):
+        yield r'.IP "\fB\-option{}\fR" 4'.format(i)
+        yield r'.IX Item "-option{}"'.format(i)
+        yield 'Description of the option number {}.'.format(i)
+
+
+def prose_page(lines_count):
+    yield PAGE_TITLE
+    yield '.SH "DESCRIPTION"'
+    for i in range(lines_count):
+        if i % 12 == 0:
+            yield '.PP'
+        elif i % 40 == 7:
+            yield 'The value is also affected by environ(7) and chmod(2).'
+        else:
+            yield 'Running text of paragraph {} explaining what the ' \
+                  'program does, with plain words only.'.format(i // 12)
+
+
+def urls_page(lines_count):
+    yield PAGE_TITLE
+    for i in range(lines_count):
+        yield 'See https://example.org/docs/v{0}/page-{0}.html or mail ' \
+              'user{0}@example.org for details.'.format(i)
+
+
+def refs_page(lines_count):
+    yield PAGE_TITLE
+    for i in range(lines_count):
+        yield r'See \fBls\fR(1), \fIstat\fR(2), page{}(3) and ' \
+              r'SSL_read(3ssl).'.format(i)
+
+
+SYNTHETIC_PAGES = (
+    ('synthetic/font-escapes', font_escapes_page),
+    ('synthetic/ip-list', ip_list_page),
+    ('synthetic/prose', prose_page),
+    ('synthetic/urls', urls_page),
+    ('synthetic/refs', refs_page),
+)
+
+
+def read_page(filename):
+    with open_page(filename) as lines:
+        return list(lines)
+
+
+def readlines_input(filename, converter):
+    not_closing_re = _alternation(converter.NOT_CLOSING_PART_TAGS)
+    with open(filename, encoding='utf-8', errors='replace') as f:
+        for line in f.readlines():
+            line = line.replace('<', '&lt;').replace('>', '&gt;').strip()
+            yield not_closing_re.sub(converter._replace_not_closing_tag,
+                                     line)
+
+
+def mapped_input(filename, converter):
+    with open_page(filename) as lines:
+        for line in lines:
+            yield converter.apply_not_closing_tags(line.strip())
+
+
+INPUT_PATHS = (('readlines', readlines_input), ('mapped', mapped_input))
+
+
+def corpus_pages(directories):
+    for directory in directories:
+        for filename in sorted(glob.glob(os.path.join(directory, '*'))):
+            if os.path.isfile(filename):
+                name = os.path.relpath(filename, os.path.dirname(directory))
+                yield name, read_page(filename)
+
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def reference_run(iterations=REFERENCE_ITERATIONS):
+    total = 0
+    for i in range(iterations):
+        total += len(str(i).replace('1', 'one'))
+    return total
+
+
+def convert_page(converter, convert, lines):
+    converter.reset()
+    convert(lines)
+
+
+def time_conversions(pages, repeat):
+    runs = {}
+    for name, lines in pages:
+        for mode in MODES:
+            converter = MAN2HTML()
+            runs[name, mode] = partial(convert_page, converter,
+                                       getattr(converter, mode), lines)
+    samples = {key: [] for key in runs}
+    for _ in range(repeat):
+        for key, run in runs.items():
+            seconds = best_time(run, 1)
+            samples[key].append((seconds,
+                                 seconds / best_time(reference_run, 1)))
+    return samples
+
+
+def measure(lines, mode, samples):
+    converter = MAN2HTML()
+    convert = getattr(converter, mode)
+    seconds = min(seconds for seconds, _ in samples)
+    converter.reset()
+    tracemalloc.start()
+    try:
+        convert(lines)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    size = sum(len(line.encode('utf-8')) for line in lines)
+    return {'seconds': seconds, 'lines_per_sec': len(lines) / seconds,
+            'bytes_per_sec': size / seconds, 'peak_bytes': peak,
+            'relative_seconds': statistics.median(
+                ratio for _, ratio in samples)}
+
+
+def measure_input(filename, read_input, repeat):
+    converter = MAN2HTML()
+    seconds = best_time(
+        lambda: deque(read_input(filename, converter), maxlen=0), repeat)
+    lines = allocated = peak = 0
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        iterator = read_input(filename, converter)
+        while True:
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            if next(iterator, None) is None:
+                break
+            line_peak = tracemalloc.get_traced_memory()[1]
+            allocated += line_peak - current
+            peak = max(peak, line_peak - start)
+            lines += 1
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds, 'lines_per_sec': lines / seconds,
+            'bytes_per_line': allocated / max(lines, 1), 'peak_bytes': peak}
+
+
+def input_paths(directories, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for directory_index, corpus in enumerate(directories):
+            for filename in sorted(glob.glob(os.path.join(corpus, '*'))):
+                if not os.path.isfile(filename):
+                    continue
+                name = os.path.relpath(filename, os.path.dirname(corpus))
+                plain = os.path.join(directory, '{}-{}'.format(
+                    directory_index, os.path.basename(filename)))
+                with open(plain, 'wb') as f:
+                    f.write(read_page_bytes(filename))
+                results[name] = {path: measure_input(plain, read_input,
+                                                     repeat)
+                                 for path, read_input in INPUT_PATHS}
+    return results
+
+
+def stage_breakdown(lines):
+    profiler = StageProfiler(slowest=0)
+    converter = MAN2HTML(profiler=profiler)
+    start = time.perf_counter()
+    converter.man2html_base(lines)
+    totals = {stage: profiler.stages.get(stage, (0.0,))[0]
+              for stage in STAGES}
+    totals['other'] = time.perf_counter() - start - sum(totals.values())
+    return totals
+
+
+def font_escapes_scaling(repeat, sizes=(100, 200, 400, 800, 1600)):
+    converter = MAN2HTML()
+    result = []
+    for size in sizes:
+        line = FONT_ESCAPES_UNIT * size
+        seconds = best_time(lambda: converter.apply_part_tags(line), repeat)
+        result.append((size * 4, seconds))
+    return result
+
+
+def construction_cost(repeat, number=10000):
+    converter = MAN2HTML()
+    construction = min(timeit.repeat(MAN2HTML, number=number,
+                                     repeat=repeat)) / number
+    reset = min(timeit.repeat(converter.reset, number=number,
+                              repeat=repeat)) / number
+    return construction, reset
+
+
+def run_benchmarks(arguments):
+    pages = list(corpus_pages([CORPUS_DIRECTORY] + arguments.corpus))
+    pages.extend((name, list(generator(arguments.lines)))
+                 for name, generator in SYNTHETIC_PAGES)
+    results = {'pages': {}, 'stages': {}}
+    samples = time_conversions(pages, arguments.repeat)
+    for name, lines in pages:
+        results['pages'][name] = {mode: measure(lines, mode,
+                                                samples[name, mode])
+                                  for mode in MODES}
+        results['stages'][name] = stage_breakdown(lines)
+    results['input'] = input_paths([CORPUS_DIRECTORY] + arguments.corpus,
+                                   arguments.repeat)
+    results['scaling'] = {
+        'font_escapes': font_escapes_scaling(arguments.repeat)}
+    construction, reset = construction_cost(arguments.repeat)
+    results['construction'] = {'init_seconds': construction,
+                               'reset_seconds': reset}
+    return results
+
+
+def print_results(results):
+    print('{:<32} {:<14} {:>12} {:>12} {:>12}'.format(
+        'page', 'mode', 'lines/s', 'KiB/s', 'peak KiB'))
+    for name, modes in results['pages'].items():
+        for mode, result in modes.items():
+            print('{:<32} {:<14} {:>12.0f} {:>12.0f} {:>12.0f}'.format(
+                name, mode, result['lines_per_sec'],
+                result['bytes_per_sec'] / 1024, result['peak_bytes'] / 1024))
+    print()
+    columns = STAGES + ('other',)
+    print('{:<32} '.format('stage share, %') +
+          ' '.join('{:>9}'.format(stage[:9]) for stage in columns))
+    for name, stages in results['stages'].items():
+        total = sum(stages.values()) or 1
+        print('{:<32} '.format(name) + ' '.join(
+            '{:>9.1f}'.format(stages[stage] / total * 100)
+            for stage in columns))
+    print()
+    print('{:<32} {:<14} {:>12} {:>12} {:>12}'.format(
+        'input + escaping', 'path', 'lines/s', 'B/line', 'peak KiB'))
+    for name, paths in results['input'].items():
+        for path, result in paths.items():
+            print('{:<32} {:<14} {:>12.0f} {:>12.0f} {:>12.0f}'.format(
+                name, path, result['lines_per_sec'],
+                result['bytes_per_line'], result['peak_bytes'] / 1024))
+    print()
+    print_scaling('apply_part_tags: font escapes per line',
+                  results['scaling']['font_escapes'])
+    print('MAN2HTML(): {:.3f} us, reset(): {:.3f} us'.format(
+        results['construction']['init_seconds'] * 1e6,
+        results['construction']['reset_seconds'] * 1e6))
+
+
+def print_scaling(title, rows):
+    print(title)
+    print('{:>10} {:>12} {:>14}'.format('items', 'seconds', 'us per item'))
+    for items, seconds in rows:
+        print('{:>10} {:>12.6f} {:>14.3f}'.format(
+            items, seconds, seconds / items * 1e6))
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    missing = []
+    for name, modes in results['pages'].items():
+        for mode, current in modes.items():
+            expected = baseline['pages'].get(name, {}).get(mode)
+            if expected is None or 'relative_seconds' not in expected:
+                missing.append((name, mode))
+                continue
+            ratio = expected['relative_seconds'] / \
+                current['relative_seconds']
+            if ratio < 1 - tolerance:
+                regressions.append((name, mode, ratio))
+    return regressions, missing
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    results = run_benchmarks(arguments)
+    print_results(results)
+    if arguments.json:
+        with open(arguments.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        regressions, missing = compare(results, baseline,
+                                       arguments.tolerance)
+        for name, mode, ratio in regressions:
+            sys.stderr.write('regression: {} {} runs at {:.0%} of the '
+                             'baseline\n'.format(name, mode, ratio))
+        for name, mode in missing:
+            sys.stderr.write('missing: {} {} is not in the '
+                             'baseline\n'.format(name, mode))
+        sys.exit(1 if regressions or missing else 0)
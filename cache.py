@@ -0,0 +1,116 @@
+import os
+import time
+import hashlib
+import tempfile
+from utils import MAN2HTML
+from ir import Document
+
+DEFAULT_MAX_SIZE = 512 << 20
+TRIM_RATIO = 0.9
+
+
+class ConversionCache(object):
+    DOCUMENT_SUFFIX = '.ir'
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(page, rules=MAN2HTML.RULES_VERSION, encoding=None):
+        digest = hashlib.sha256()
+        for part in (rules.encode('utf-8'),
+                     (encoding or 'auto').encode('ascii'), page):
+            digest.update(str(len(part)).encode('ascii') + b':')
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key, suffix=DOCUMENT_SUFFIX):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    @staticmethod
+    def _touch(path):
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            self._touch(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def get_document(self, key):
+        data = self._read(self._path(key))
+        return None if data is None else Document.loads(data)
+
+    def put_document(self, key, document):
+        self._write(self._path(key), document.dumps())
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self._touch(temp_path)
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        if self.max_size is None:
+            return
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        else:
+            self._size += len(data) - replaced
+        if self._size > self.max_size:
+            self.trim()
+
+    def entries(self):
+        for subdirectory in os.scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for entry in os.scandir(subdirectory.path):
+                if not entry.name.endswith(self.DOCUMENT_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime_ns
+
+    def trim(self, max_size=None):
+        max_size = self.max_size if max_size is None else max_size
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        if size > max_size:
+            target = max_size * TRIM_RATIO
+            for path, entry_size, _ in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+                self.evictions += 1
+        self._size = size
+        return size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
@@ -0,0 +1,88 @@
+import os
+import posixpath
+from types import MappingProxyType
+from utils import MAN2HTML
+from pageio import write_atomic
+
+STYLESHEET_NAME = 'man.css'
+MAX_INDENT = 16
+FONT_SIZES = range(1, 41)
+
+
+def class_rules():
+    rules = ['.db{display:block}', '.di{display:inline}',
+             '.mr{margin-right:1em}']
+    rules.extend('.p{0}{{padding-left:{0}em}}'.format(indent)
+                 for indent in range(MAX_INDENT + 1))
+    rules.extend('.f{0}{{font-size:{0}pt}}'.format(size)
+                 for size in FONT_SIZES)
+    return '\n'.join(rules) + '\n'
+
+
+class CompactMAN2HTML(MAN2HTML):
+    DISPLAY_CLASSES = ('db', 'di')
+    STYLESHEET = MAN2HTML.STYLESHEET + class_rules()
+    HEADER = '''
+<html>
+  <head>
+    <meta charset="utf-8" />
+    <link rel="stylesheet" href="{}" />
+{}  </head>
+  <body>
+    <span>
+'''
+    INLINE_TAGS = MappingProxyType({
+        **MAN2HTML.INLINE_TAGS,
+        r'.SM': '',
+        r'.IX ': r'</div><div class="p4">',
+        r'\&': r'<span class="mr">{}</span>',
+    })
+
+    def _display_attribute(self, inline):
+        return 'class="{}"'.format(self.DISPLAY_CLASSES[inline])
+
+    def _indent_attribute(self, padding, inline=None):
+        classes = []
+        padding = str(padding)
+        if padding.isdigit() and int(padding) <= MAX_INDENT:
+            classes.append('p{}'.format(int(padding)))
+        elif padding:
+            return super()._indent_attribute(padding, inline)
+        if inline is not None:
+            classes.append(self.DISPLAY_CLASSES[inline])
+        return 'class="{}"'.format(' '.join(classes))
+
+    def _font_open(self, size):
+        if size in FONT_SIZES:
+            return '</span><span class="f{}">'.format(size)
+        return super()._font_open(size)
+
+    def stylesheet_href(self):
+        page_path = self.state.page_path
+        if page_path is None:
+            return STYLESHEET_NAME
+        return posixpath.relpath(STYLESHEET_NAME,
+                                 posixpath.dirname(page_path) or '.')
+
+    def page_header(self, styles=''):
+        if styles:
+            styles = '    <style>\n{}\n    </style>\n'.format(styles)
+        return self.HEADER.format(self.stylesheet_href(), styles)
+
+
+def stylesheet_directory(output, page_path=None):
+    directory = os.path.dirname(output)
+    if page_path:
+        for _ in filter(None, posixpath.dirname(page_path).split('/')):
+            directory = os.path.dirname(directory)
+    return directory
+
+
+def stylesheet(styles=''):
+    return CompactMAN2HTML.STYLESHEET + styles
+
+
+def write_stylesheet(directory, styles=''):
+    filename = os.path.join(directory, STYLESHEET_NAME)
+    write_atomic(filename, stylesheet(styles))
+    return filename
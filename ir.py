@@ -0,0 +1,221 @@
+import re
+import html
+import marshal
+import textwrap
+from array import array
+from types import MappingProxyType
+from utils import Info, Heading
+
+FORMAT_VERSION = 3
+TEXT = 'text'
+PRE = 'pre'
+TEXT_WIDTH = 78
+TEXT_INDENT = 7
+SUBHEADER_INDENT = 3
+BREAK_KINDS = frozenset(('.PP', '.P', '.LP', '.TP', '.br', 'start_paragraph',
+                         'pad_right', 'pad_left', '.IX '))
+TOKEN_RE = re.compile('\x00(?:d([01])|i([^\x00\x01]*)\x01([01]?)|'
+                      'f(-?\\d+)|o(\\d+)|c(\\d+)|(z))\x00')
+NUL_TOKEN = '\x00z\x00'
+TAG_RE = re.compile('<[^>]*>|' + TOKEN_RE.pattern)
+_structural_classes = {}
+
+
+class Document(object):
+    __slots__ = ('kind_names', 'kinds', 'payloads', 'info', 'page_title',
+                 'headers', '_codes')
+
+    def __init__(self, kind_names=(), kinds=b'', payloads=None, info=None,
+                 page_title='', headers=None):
+        self.kind_names = list(kind_names)
+        self.kinds = array('H', kinds)
+        self.payloads = [] if payloads is None else payloads
+        self.info = info
+        self.page_title = page_title
+        self.headers = [] if headers is None else headers
+        self._codes = {name: code for code, name in enumerate(kind_names)}
+
+    def append(self, kind, payload):
+        code = self._codes.get(kind)
+        if code is None:
+            code = self._codes[kind] = len(self.kind_names)
+            self.kind_names.append(kind)
+        self.kinds.append(code)
+        self.payloads.append(payload)
+
+    def extend(self, other):
+        for kind, payload in other.lines():
+            self.append(kind, payload)
+        self.headers.extend(other.headers)
+        if other.info is not None:
+            self.info = other.info
+            self.page_title = other.page_title
+
+    def lines(self):
+        names = self.kind_names
+        return ((names[code], payload)
+                for code, payload in zip(self.kinds, self.payloads))
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def dumps(self):
+        return marshal.dumps((
+            FORMAT_VERSION, tuple(self.kind_names), self.kinds.tobytes(),
+            self.payloads, None if self.info is None else tuple(self.info),
+            self.page_title, [tuple(header) for header in self.headers]))
+
+    @classmethod
+    def loads(cls, data):
+        version, kind_names, kinds, payloads, info, page_title, headers = \
+            marshal.loads(data)
+        if version != FORMAT_VERSION:
+            raise ValueError('unsupported document format {}'.format(version))
+        return cls(kind_names, kinds, payloads,
+                   None if info is None else Info(*info), page_title,
+                   [Heading(*header) for header in headers])
+
+
+class StructuralMixin(object):
+    def _display_attribute(self, inline):
+        return '\x00d{:d}\x00'.format(inline)
+
+    def _indent_attribute(self, padding, inline=None):
+        return '\x00i{}\x01{}\x00'.format(
+            padding, '' if inline is None else int(inline))
+
+    def _font_open(self, size):
+        return '\x00f{}\x00'.format(size)
+
+
+def structural_class(cls):
+    if issubclass(cls, StructuralMixin):
+        return cls
+    result = _structural_classes.get(cls)
+    if result is None:
+        tags = dict(cls.INLINE_TAGS)
+        for index, tag in enumerate(cls.THEMED_TAGS):
+            _, separator, _ = tags[tag].partition('{}')
+            tags[tag] = '\x00o{0}\x00{1}{2}'.format(
+                index, separator, separator and '\x00c{}\x00'.format(index))
+        result = _structural_classes[cls] = type(
+            'Structural' + cls.__name__, (StructuralMixin, cls),
+            {'INLINE_TAGS': MappingProxyType(tags)})
+    return result
+
+
+def structural(converter):
+    cls = structural_class(type(converter))
+    if type(converter) is cls:
+        return converter
+    twin = cls(xref=converter.xref, profiler=converter.profiler, macros=False)
+    twin.indexer = converter.indexer
+    twin.macros = converter.macros
+    twin.state = converter.state
+    return twin
+
+
+def expand_tokens(converter, text):
+    if '\x00' not in text:
+        return text
+    tags = [converter.INLINE_TAGS[tag].partition('{}')
+            for tag in converter.THEMED_TAGS]
+
+    def replace(match):
+        inline, padding, indent_inline, size, opening, closing, _ = \
+            match.groups()
+        if inline is not None:
+            return converter._display_attribute(int(inline))
+        if padding is not None:
+            return converter._indent_attribute(
+                padding, int(indent_inline) if indent_inline else None)
+        if size is not None:
+            return converter._font_open(int(size))
+        if opening is not None:
+            return tags[int(opening)][0]
+        if closing is not None:
+            return tags[int(closing)][2]
+        return '\x00'
+    return TOKEN_RE.sub(replace, text)
+
+
+def parse(converter, text_lines):
+    converter = structural(converter)
+    state = converter.state
+    kinds = {tag: handler.lstrip('_')
+             for tag, handler in converter.INLINE_FUNCTIONS.items()}
+    document = Document()
+    text_lines = (line.replace('\x00', NUL_TOKEN) for line in text_lines)
+    for payload in converter.convert_lines(text_lines):
+        request = state.request
+        if request is None:
+            kind = PRE if state.pre_open else TEXT
+        else:
+            kind = kinds.get(request, request)
+        document.append(kind, payload)
+    document.info = state.info
+    document.page_title = state.page_title
+    document.headers = list(state.headers)
+    return document
+
+
+def render_html(converter, document, styles=''):
+    state = converter.state
+    state.headers = list(document.headers)
+    state.info = document.info
+    state.page_title = document.page_title
+    return expand_tokens(converter, converter.page_beginning(styles) +
+                         '\n'.join(document.payloads) +
+                         converter.page_ending())
+
+
+def plain_text(payload):
+    return html.unescape(TAG_RE.sub('', payload))
+
+
+def render_text(document, width=TEXT_WIDTH):
+    result = []
+    words = []
+    headed = False
+
+    def flush():
+        if words:
+            result.extend(textwrap.wrap(
+                ' '.join(words), width, initial_indent=' ' * TEXT_INDENT,
+                subsequent_indent=' ' * TEXT_INDENT))
+            del words[:]
+
+    info = document.info
+    if info is not None:
+        title = '{}({})'.format(info.name, info.num)
+        result.append(title + 'General Commands Manual'.center(
+            max(0, width - 2 * len(title))) + title)
+    for kind, payload in document.lines():
+        if kind == PRE:
+            flush()
+            result.append(' ' * TEXT_INDENT + plain_text(payload).rstrip())
+            continue
+        text = ' '.join(plain_text(payload).split())
+        if kind == 'start_header':
+            flush()
+            result.extend(('', text))
+            headed = True
+            continue
+        if kind == 'start_subheader':
+            flush()
+            result.extend(('', ' ' * SUBHEADER_INDENT + text))
+            headed = True
+            continue
+        if kind in BREAK_KINDS:
+            flush()
+            if result and result[-1] and not headed:
+                result.append('')
+        if text:
+            words.append(text)
+            headed = False
+    flush()
+    if info is not None:
+        title = '{}({})'.format(info.name, info.num)
+        result.extend(('', info.ver + info.date.center(
+            max(0, width - len(info.ver) - len(title))) + title))
+    return '\n'.join(result) + '\n'
@@ -0,0 +1,540 @@
+import re
+import bisect
+import functools
+from operator import add
+from itertools import accumulate, chain, count, islice, repeat
+from types import MappingProxyType
+from collections import OrderedDict
+
+MAX_DEPTH = 32
+MAX_SIZE = 1 << 16
+MAX_CALLS = 1 << 12
+MEMO_SIZE = 1 << 12
+EXPAND_BATCH = 512
+PREAMBLE_CACHE_SIZE = 64
+CONTROL_CHARACTERS = ('.', "'")
+CONDITION_LETTERS = MappingProxyType({
+    'n': True, 't': False, 'o': True, 'e': False, 'v': False,
+})
+NAME_CONDITIONS = ('r', 'd', 'c', 'm', 'F', 'S')
+NUMBER_STARTS = '0123456789+-(.|\\'
+UNITS = MappingProxyType({
+    '': 1, 'u': 1, 'i': 240, 'c': 240 * 50 / 127, 'p': 240 / 72, 'P': 40,
+    'm': 24, 'n': 24, 'v': 40, 'M': 0.24,
+})
+OPERATORS = MappingProxyType({
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: int(a / b),
+    '%': lambda a, b: int(a % b),
+    '<': lambda a, b: int(a < b),
+    '>': lambda a, b: int(a > b),
+    '<=': lambda a, b: int(a <= b),
+    '>=': lambda a, b: int(a >= b),
+    '=': lambda a, b: int(a == b),
+    '==': lambda a, b: int(a == b),
+    '&': lambda a, b: int(a > 0 and b > 0),
+    ':': lambda a, b: int(a > 0 or b > 0),
+})
+DEFAULT_REGISTERS = MappingProxyType({'.g': 1, '.H': 24, '.V': 40})
+DEFAULT_STRINGS = MappingProxyType({
+    'lq': '“', 'rq': '”', 'R': '®', 'Tm': '™',
+})
+DEFINING_REQUESTS = ('de', 'de1', 'am', 'am1', 'ig')
+PREAMBLE_REQUESTS = frozenset(DEFINING_REQUESTS + (
+    'ds', 'ds1', 'as', 'as1', 'nr', 'rr', 'rm', 'rn', 'als', 'tr', 'tm',
+    'if', 'ie', 'el'))
+
+REQUEST_RE = re.compile(r"[.'][ \t]*([^\s\\]*)[ \t]*(.*)", re.DOTALL)
+ESCAPE_RE = re.compile(r'\\(?:\\|([*n])(?:\[([^\]\n]*)\]|\((..)|(.))|'
+                       r'\$(\d|\*|@))')
+MOTION_RE = re.compile(r"\\[hv]'[^']*'")
+COMMENT_RE = re.compile(r'\\[\\"]')
+ARGUMENT_RE = re.compile(r'"((?:[^"]|"")*)(?:"|$)|(\S+)')
+TRIGGER_ESCAPE_RE = re.compile(r'\\[*n}]')
+TOKEN_RE = re.compile(r'\s*(?:(\d*\.?\d+)([uicpPmnvM]?)|'
+                      r'(<=|>=|==|[-+*/%<>=&:()]))')
+
+_preambles = OrderedDict()
+
+
+@functools.lru_cache(maxsize=PREAMBLE_CACHE_SIZE)
+def trigger_re(names):
+    return re.compile(
+        r'\n[.\'][ \t]*(?:[^\s\\]*\\(?!")|(?:{})(?![^\s\\]))'.format(
+            '|'.join(re.escape(name) for name in
+                     sorted(names, key=len, reverse=True))))
+
+
+def strip_comment(text):
+    for match in COMMENT_RE.finditer(text):
+        if match.group() == '\\"':
+            return text[:match.start()]
+    return text
+
+
+def parse_arguments(text):
+    return [word or quoted.replace('""', '"')
+            for quoted, word in ARGUMENT_RE.findall(text)]
+
+
+def _operand(text, position, depth):
+    sign = 1
+    while True:
+        match = TOKEN_RE.match(text, position)
+        if match is None:
+            raise ValueError('bad number in {!r}'.format(text))
+        number, unit, operator = match.groups()
+        if operator not in ('-', '+'):
+            break
+        if operator == '-':
+            sign = -sign
+        position = match.end()
+    if number is not None:
+        return sign * float(number) * UNITS[unit], match.end()
+    if operator == '(':
+        if depth >= MAX_DEPTH:
+            raise ValueError('too deeply nested {!r}'.format(text))
+        value, position = _expression(text, match.end(), depth + 1)
+        match = TOKEN_RE.match(text, position)
+        if match is None or match.group(3) != ')':
+            raise ValueError('unbalanced parentheses in {!r}'.format(text))
+        return sign * value, match.end()
+    raise ValueError('bad number in {!r}'.format(text))
+
+
+def _expression(text, position, depth=0):
+    value, position = _operand(text, position, depth)
+    while True:
+        match = TOKEN_RE.match(text, position)
+        if match is None or match.group(3) in (None, '(', ')'):
+            return value, position
+        right, position = _operand(text, match.end(), depth)
+        value = OPERATORS[match.group(3)](value, right)
+
+
+def evaluate(text):
+    value, position = _expression(text, 0)
+    if text[position:].strip():
+        raise ValueError('trailing characters in {!r}'.format(text))
+    return int(value)
+
+
+class MacroProcessor(object):
+    REQUESTS = MappingProxyType({
+        'de': '_define_macro',
+        'de1': '_define_macro',
+        'am': '_define_macro',
+        'am1': '_define_macro',
+        'ig': '_define_macro',
+        'ds': '_define_string',
+        'ds1': '_define_string',
+        'as': '_define_string',
+        'as1': '_define_string',
+        'nr': '_set_register',
+        'rr': '_remove_registers',
+        'rm': '_remove_names',
+        'rn': '_rename',
+        'als': '_alias',
+        'tr': '_discard',
+        'tm': '_discard',
+        'nop': '_no_operation',
+        'if': '_if',
+        'ie': '_if_else',
+        'el': '_else',
+    })
+
+    def __init__(self, builtins=frozenset()):
+        self.builtins = frozenset(builtins)
+        self.reset()
+
+    def reset(self):
+        self.strings = dict(DEFAULT_STRINGS)
+        self.macros = {}
+        self.registers = dict(DEFAULT_REGISTERS)
+        self._conditions = []
+        self._definition = None
+        self._skip = 0
+        self._memo = {}
+        self._generation = 0
+        self._trigger = None
+        self._preamble_read = False
+        self._budget = MAX_SIZE
+        self._calls = MAX_CALLS
+
+    def _changed(self, macros=False):
+        self._generation += 1
+        self._memo.clear()
+        if macros:
+            self._trigger = None
+
+    def _escape(self, match, arguments, copy, numeric, depth):
+        kind = match.group(1)
+        if kind is None:
+            argument = match.group(5)
+            if argument is None:
+                return '\\' if copy else match.group(0)
+            if arguments is None:
+                return match.group(0)
+            if argument == '*':
+                return ' '.join(arguments)
+            if argument == '@':
+                return ' '.join('"{}"'.format(value) for value in arguments)
+            number = int(argument)
+            return arguments[number - 1] \
+                if 0 < number <= len(arguments) else ''
+        name = match.group(2) or match.group(3) or match.group(4)
+        if kind == 'n':
+            value = self.registers.get(name)
+            if value is None:
+                return '0' if numeric else match.group(0)
+            return str(value)
+        value = self.strings.get(name.split(' ', 1)[0])
+        if value is None:
+            return match.group(0)
+        self._budget -= len(value)
+        if self._budget < 0:
+            return match.group(0)
+        if '\\' in value and depth < MAX_DEPTH:
+            return self.interpolate(value, depth=depth + 1)
+        return value
+
+    def interpolate(self, text, arguments=None, copy=False, numeric=False,
+                    depth=0):
+        result = ESCAPE_RE.sub(
+            lambda match: self._escape(match, arguments, copy, numeric,
+                                       depth), text)
+        return text if len(result) > MAX_SIZE else result
+
+    def expand_text(self, line):
+        result = self._memo.get(line)
+        if result is None:
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            result = self._memo[line] = self.interpolate(line)
+        return result
+
+    def _condition(self, text):
+        text = text.lstrip()
+        negate = False
+        while text.startswith('!'):
+            negate = not negate
+            text = text[1:]
+        first = text[:1]
+        if first in CONDITION_LETTERS:
+            return CONDITION_LETTERS[first] != negate, text[1:]
+        if first in NAME_CONDITIONS:
+            name, _, body = text[1:].lstrip().partition(' ')
+            if first == 'r':
+                value = name in self.registers
+            elif first == 'd':
+                value = name in self.strings or name in self.macros
+            else:
+                value = False
+            return value != negate, body
+        if first and not first.isalnum() and first not in NUMBER_STARTS:
+            parts = text[1:].split(first, 2)
+            if len(parts) < 3:
+                return False, ''
+            left, right, body = parts
+            return (self.interpolate(left) == self.interpolate(right)) != \
+                negate, body
+        expression, _, body = text.partition(' ')
+        try:
+            value = evaluate(self.interpolate(expression, numeric=True)) > 0
+        except (ValueError, ArithmeticError):
+            value = False
+        return value != negate, body
+
+    def _branch(self, value, body, depth):
+        body = body.lstrip(' \t')
+        if body.startswith('\\{'):
+            body = body[2:]
+            if not value:
+                self._skip = max(0, 1 + body.count('\\{') -
+                                 body.count('\\}'))
+                return ()
+            body = body.lstrip(' \t')
+            if body == '\\':
+                return ()
+        if not value or not body:
+            return ()
+        return self._expand_line(body, depth, nested=True)
+
+    def _if(self, name, text, depth):
+        return self._branch(*self._condition(text), depth)
+
+    def _if_else(self, name, text, depth):
+        value, body = self._condition(text)
+        self._conditions.append(value)
+        return self._branch(value, body, depth)
+
+    def _else(self, name, text, depth):
+        value = not self._conditions.pop() if self._conditions else False
+        return self._branch(value, text, depth)
+
+    def _define_macro(self, name, text, depth):
+        arguments = strip_comment(text).split()
+        if name != 'ig' and not arguments:
+            return ()
+        macro = None if name == 'ig' else arguments.pop(0)
+        end = arguments[0] if arguments else '.'
+        lines = list(self.macros.get(macro, ())) if name[:2] == 'am' else []
+        self._definition = (macro, end, lines)
+        return ()
+
+    def _define_line(self, line):
+        macro, end, lines = self._definition
+        match = REQUEST_RE.match(line)
+        if line[:1] == '.' and match.group(1) == end:
+            self._definition = None
+            if macro is not None:
+                self.macros[macro] = tuple(lines)
+                self._changed(macros=True)
+        elif macro is not None and (match is None or match.group(1) or
+                                    not match.group(2).startswith('\\"')):
+            lines.append(self.interpolate(line.rstrip('\n'), copy=True) + '\n')
+
+    def _define_string(self, name, text, depth):
+        string, _, value = strip_comment(text).partition(' ')
+        if not string:
+            return ()
+        value = value.lstrip(' \t')
+        if value.startswith('"'):
+            value = value[1:]
+        value = MOTION_RE.sub('', self.interpolate(value, copy=True))
+        if name[:2] == 'as':
+            value = self.strings.get(string, '') + value
+        if len(value) > MAX_SIZE:
+            return ()
+        self.strings[string] = value
+        self._changed()
+        return ()
+
+    def _set_register(self, name, text, depth):
+        arguments = strip_comment(text).split()
+        if len(arguments) < 2:
+            return ()
+        register, expression = arguments[:2]
+        try:
+            value = evaluate(self.interpolate(expression, numeric=True))
+        except (ValueError, ArithmeticError):
+            return ()
+        if expression[:1] in ('+', '-') and register in self.registers:
+            value += self.registers[register]
+        self.registers[register] = value
+        self._changed()
+        return ()
+
+    def _remove_registers(self, name, text, depth):
+        for register in strip_comment(text).split():
+            self.registers.pop(register, None)
+        self._changed()
+        return ()
+
+    def _remove_names(self, name, text, depth):
+        for string in strip_comment(text).split():
+            self.strings.pop(string, None)
+            self.macros.pop(string, None)
+        self._changed(macros=True)
+        return ()
+
+    def _rename(self, name, text, depth):
+        arguments = strip_comment(text).split()
+        if len(arguments) == 2:
+            old, new = arguments
+            for table in (self.strings, self.macros):
+                if old in table:
+                    table[new] = table.pop(old)
+            self._changed(macros=True)
+        return ()
+
+    def _alias(self, name, text, depth):
+        arguments = strip_comment(text).split()
+        if len(arguments) == 2:
+            new, old = arguments
+            for table in (self.strings, self.macros):
+                if old in table:
+                    table[new] = table[old]
+            self._changed(macros=True)
+        return ()
+
+    def _discard(self, name, text, depth):
+        return ()
+
+    def _no_operation(self, name, text, depth):
+        if not text.strip():
+            return ()
+        return self._expand_line(text + '\n', depth, nested=True)
+
+    def _call(self, name, arguments, depth):
+        self._calls -= 1
+        if depth >= MAX_DEPTH or self._calls < 0:
+            return ()
+        key = (name, tuple(arguments))
+        result = self._memo.get(key)
+        if result is not None:
+            return result
+        generation = self._generation
+        conditions = list(self._conditions)
+        result = []
+        for line in self.macros[name]:
+            if '\\$' in line:
+                line = self.interpolate(line, arguments)
+            for new_line in self._expand_line(line, depth + 1, nested=True):
+                self._budget -= len(new_line)
+                if self._budget < 0:
+                    return result
+                result.append(new_line)
+        if self._generation == generation and \
+                self._conditions == conditions and \
+                self._definition is None and not self._skip and \
+                self._calls >= 0:
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[key] = result
+        return result
+
+    def _expand_line(self, line, depth, nested=False):
+        if self._definition is not None:
+            self._define_line(line)
+            return ()
+        if self._skip:
+            self._skip = max(0, self._skip + line.count('\\{') -
+                             line.count('\\}'))
+            return ()
+        if '\\}' in line:
+            line = line.replace('\\}', '')
+            if line.strip() in ('', '.', "'", "'br"):
+                return ()
+        if line[:1] in CONTROL_CHARACTERS:
+            name, text = REQUEST_RE.match(line.rstrip('\n')).groups()
+            if not name and text.startswith('\\"'):
+                return (line,)
+            handler = self.REQUESTS.get(name)
+            if handler is not None:
+                return getattr(self, handler)(name, text, depth)
+            if name in self.macros and name not in self.builtins:
+                return self._call(name, parse_arguments(
+                    self.interpolate(strip_comment(text))), depth)
+            if nested:
+                if name not in self.builtins and name.islower():
+                    return ()
+                line = '.{} {}\n'.format(name, text) if text else \
+                    '.{}\n'.format(name)
+        if '\\*' in line or '\\n' in line:
+            return (self.expand_text(line),)
+        return (line,)
+
+    def _read_preamble(self, lines):
+        end = None
+        depth = 0
+        for number, line in enumerate(lines):
+            if end is not None:
+                match = REQUEST_RE.match(line)
+                if line[:1] == '.' and match.group(1) == end:
+                    end = None
+                continue
+            if depth:
+                depth = max(0, depth + line.count('\\{') -
+                            line.count('\\}'))
+                continue
+            if line[:1] not in CONTROL_CHARACTERS:
+                return number
+            name, text = REQUEST_RE.match(line.rstrip('\n')).groups()
+            if not name and text.startswith('\\"'):
+                continue
+            if name not in PREAMBLE_REQUESTS:
+                return number
+            if name in DEFINING_REQUESTS:
+                arguments = strip_comment(text).split()
+                if name != 'ig':
+                    arguments = arguments[1:]
+                end = arguments[0] if arguments else '.'
+            depth = max(0, line.count('\\{') - line.count('\\}'))
+        return len(lines)
+
+    def _expand_preamble(self, preamble):
+        key = (self.builtins, frozenset(self.strings.items()),
+               frozenset(self.macros.items()),
+               frozenset(self.registers.items()), tuple(self._conditions),
+               ''.join(preamble))
+        cached = _preambles.get(key)
+        if cached is not None:
+            _preambles.move_to_end(key)
+            strings, macros, registers, conditions, output, origins = cached
+            self.strings = dict(strings)
+            self.macros = dict(macros)
+            self.registers = dict(registers)
+            self._conditions = list(conditions)
+            self._changed(macros=True)
+            return output, origins
+        output = []
+        origins = []
+        for number, line in enumerate(preamble):
+            self._budget = MAX_SIZE
+            self._calls = MAX_CALLS
+            output.extend(self._expand_line(line, 0))
+            origins.extend(repeat(number, len(output) - len(origins)))
+        if self._generation and self._definition is None and \
+                not self._skip:
+            _preambles[key] = (dict(self.strings), dict(self.macros),
+                               dict(self.registers), tuple(self._conditions),
+                               tuple(output), tuple(origins))
+            if len(_preambles) > PREAMBLE_CACHE_SIZE:
+                _preambles.popitem(last=False)
+        return output, origins
+
+    def _trigger_lines(self, lines, start=0):
+        if self._trigger is None:
+            self._trigger = trigger_re(frozenset(self.REQUESTS).union(
+                name for name in self.macros if name not in self.builtins))
+        lines = lines[start:]
+        text = '\n' + '\n'.join(lines)
+        positions = [match.start() for match in chain(
+            TRIGGER_ESCAPE_RE.finditer(text), self._trigger.finditer(text))]
+        if not positions:
+            return positions
+        starts = list(map(add, accumulate(map(len, lines), initial=0),
+                          count(1)))
+        return sorted({start + bisect.bisect_right(starts, position + 1) - 1
+                       for position in positions})
+
+    def expand(self, lines, origins=None):
+        result = []
+        number = 0
+        if not self._preamble_read:
+            self._preamble_read = True
+            number = self._read_preamble(lines)
+            output, output_origins = self._expand_preamble(lines[:number])
+            result.extend(output)
+            if origins is not None:
+                origins.extend(output_origins)
+        triggers = self._trigger_lines(lines, number)
+        while number < len(lines):
+            if self._definition is None and not self._skip:
+                index = bisect.bisect_left(triggers, number)
+                end = triggers[index] if index < len(triggers) else len(lines)
+                result.extend(lines[number:end])
+                if origins is not None:
+                    origins.extend(range(number, end))
+                number = end
+                if number == len(lines):
+                    break
+            self._budget = MAX_SIZE
+            self._calls = MAX_CALLS
+            result.extend(self._expand_line(lines[number], 0))
+            if origins is not None:
+                origins.extend(repeat(number, len(result) - len(origins)))
+            number += 1
+            if self._trigger is None:
+                triggers = self._trigger_lines(lines, number)
+        return result
+
+    def expand_lines(self, lines):
+        lines = iter(lines)
+        batch = list(islice(lines, EXPAND_BATCH))
+        while batch:
+            yield from self.expand(batch)
+            batch = list(islice(lines, EXPAND_BATCH))
@@ -1,9 +1,18 @@
 #!/usr/bin/python3
 
 import sys
+import codecs
 import contextlib
+from functools import partial
 from argparse import ArgumentParser
 from utils import MAN2HTML
+from cache import ConversionCache, DEFAULT_MAX_SIZE
+from xref import PageIndex
+from profiling import StageProfiler
+from pageio import open_page, read_page, open_output, decode_lines
+from parallel import ParallelConverter
+from ir import parse, render_html, render_text
+from compact import CompactMAN2HTML, stylesheet_directory, write_stylesheet
 
 
 def get_arguments():
@@ -12,30 +21,114 @@ def get_arguments():
                         help='Input file (e.g. tmp.txt)', required=True)
     parser.add_argument('-o', '--output', dest='output', metavar='FILE',
                         help='Output file (e.g. tmp.html)')
+    parser.add_argument('-e', '--encoding', dest='encoding',
+                        help='Input encoding (default: the coding: preamble, '
+                             'utf-8, or latin-1 for lines that aren\'t utf-8)')
     parser.add_argument('-s', '--style', dest='style', metavar='FILE',
                         help='Styles file (e.g. style.css)')
+    parser.add_argument('-c', '--cache', dest='cache', metavar='DIR',
+                        help='Conversion cache directory')
+    parser.add_argument('--cache-size', dest='cache_size', metavar='MB',
+                        type=int, default=DEFAULT_MAX_SIZE >> 20,
+                        help='Conversion cache size limit in megabytes')
+    parser.add_argument('-x', '--xref', dest='xref', metavar='FILE',
+                        help='Page index built by batch.py --xref')
+    parser.add_argument('--page-path', dest='page_path', metavar='PATH',
+                        help='Output path of this page inside the indexed '
+                             'tree (e.g. man1/ls.1.html)')
+    parser.add_argument('-p', '--profile', dest='profile', metavar='N',
+                        type=int, nargs='?', const=10,
+                        help='Print time spent in every conversion stage '
+                             'and the N slowest input lines to stderr')
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help='Use short class names and write the styles '
+                             'into man.css at the root of the output tree')
+    parser.add_argument('-z', '--compress', dest='compress',
+                        action='store_true',
+                        help='Write gzipped output into FILE.gz')
+    parser.add_argument('-k', '--keep-uncompressed', dest='keep',
+                        action='store_true',
+                        help='Write uncompressed output next to FILE.gz')
+    parser.add_argument('-f', '--format', dest='format', default='html',
+                        choices=('html', 'text'),
+                        help='Output format (default: html)')
+    parser.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int,
+                        help='Convert the sections of a large page in N '
+                             'processes')
     args = parser.parse_args()
+    if args.encoding:
+        try:
+            codecs.lookup(args.encoding)
+        except LookupError:
+            parser.error('unknown encoding {}'.format(args.encoding))
+    if args.jobs and args.profile is not None:
+        parser.error('--profile can\'t be combined with --jobs')
+    if args.compress and not args.output:
+        parser.error('--compress requires --output')
+    if args.compact and not args.output:
+        parser.error('--compact requires --output')
     return args
 
 
 @contextlib.contextmanager
-def file_open(filename=None):
-    opened_file = open(filename, 'w') if filename else sys.stdout
-    try:
+def file_open(filename=None, compress=False, keep=False):
+    if not filename:
+        yield sys.stdout
+        return
+    with open_output(filename, compress, keep) as opened_file:
         yield opened_file
-    finally:
-        if opened_file is not sys.stdout:
-            opened_file.close()
 
 if __name__ == '__main__':
     arguments = get_arguments()
-    with open(arguments.input) as f:
-        man_text = f.readlines()
     if arguments.style:
         with open(arguments.style) as f:
             styles = f.read()
     else:
         styles = ''
-    with file_open(arguments.output) as f:
-        converter = MAN2HTML()
-        f.write(converter.man2html(man_text, styles=styles))
+    xref = PageIndex(arguments.xref) if arguments.xref else None
+    profiler = None
+    if arguments.profile is not None:
+        profiler = StageProfiler(slowest=arguments.profile)
+    converter_class = CompactMAN2HTML if arguments.compact else MAN2HTML
+    if arguments.compact:
+        write_stylesheet(stylesheet_directory(arguments.output,
+                                              arguments.page_path), styles)
+        styles = ''
+    converter = converter_class(xref=xref, profiler=profiler)
+    converter.reset(page_path=arguments.page_path)
+    if arguments.jobs:
+        parallel = ParallelConverter(arguments.jobs, arguments.xref,
+                                     converter_class=converter_class)
+        parse_page = partial(parallel.parse, page_path=arguments.page_path)
+    else:
+        parse_page = partial(parse, converter)
+    document = None
+    if arguments.cache:
+        cache = ConversionCache(arguments.cache, arguments.cache_size << 20)
+        page = read_page(arguments.input)
+        key = cache.key(page, rules=converter.rules_version(),
+                        encoding=arguments.encoding)
+        document = cache.get_document(key)
+        if document is None:
+            document = parse_page(decode_lines(page, arguments.encoding))
+            cache.put_document(key, document)
+    elif arguments.jobs or arguments.format != 'html':
+        with open_page(arguments.input, arguments.encoding) as man_text:
+            document = parse_page(man_text)
+    if document is not None:
+        if arguments.format == 'text':
+            output = render_text(document)
+        else:
+            output = render_html(converter, document, styles)
+        with file_open(arguments.output, arguments.compress,
+                       arguments.keep) as f:
+            f.write(output)
+    else:
+        with open_page(arguments.input, arguments.encoding) as man_text, \
+                file_open(arguments.output, arguments.compress,
+                          arguments.keep) as f:
+            converter.man2html_stream(man_text, f, styles=styles)
+    if arguments.jobs:
+        parallel.close()
+    if profiler is not None:
+        profiler.report(sys.stderr)
@@ -0,0 +1,231 @@
+import io
+import os
+import re
+import stat
+import bz2
+import gzip
+import lzma
+import mmap
+import codecs
+import tempfile
+import contextlib
+from functools import partial
+from itertools import chain
+
+COMPRESSION_SUFFIXES = ('.gz', '.bz2', '.xz')
+MAGIC_NUMBERS = ((b'\x1f\x8b', gzip.open), (b'BZh', bz2.open),
+                 (b'\xfd7zXZ\x00', lzma.open))
+MAGIC_SIZE = 6
+GZIP_SUFFIX = '.gz'
+CODING_RE = re.compile(
+    rb'^[.\']\\"[^\n]*?-\*-[^\n]*?\bcoding:\s*([\w.:-]+?)(?:-unix|-dos|-mac)?'
+    rb'(?:[\s;]|-\*-|$)', re.MULTILINE)
+CODING_LINES = 2
+BLOCK_SIZE = 1 << 14
+
+
+def detect_opener(f):
+    magic = f.peek(MAGIC_SIZE)[:MAGIC_SIZE]
+    for prefix, opener in MAGIC_NUMBERS:
+        if magic.startswith(prefix):
+            return opener
+    return None
+
+
+@contextlib.contextmanager
+def open_input(filename):
+    with open(filename, 'rb') as f:
+        opener = detect_opener(f)
+        if opener is None:
+            yield f
+            return
+        with opener(f, 'rb') as decompressed:
+            yield decompressed
+
+
+def detect_encoding(data):
+    if data[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+        return 'utf-8-sig'
+    end = -1
+    for _ in range(CODING_LINES):
+        end = data.find(b'\n', end + 1)
+        if end < 0:
+            end = len(data)
+            break
+    match = CODING_RE.search(data[:end])
+    if match is None:
+        return None
+    try:
+        return codecs.lookup(match.group(1).decode('ascii')).name
+    except LookupError:
+        return None
+
+
+def _decode_block(block):
+    try:
+        return codecs.utf_8_decode(block, 'strict', True)[0]
+    except UnicodeDecodeError:
+        return ''.join(_decode_line(line)
+                       for line in bytes(block).splitlines(True))
+
+
+def _decode_line(line):
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        return line.decode('latin-1')
+
+
+def _text_lines(text):
+    lines = text.splitlines(True)
+    if '\r' not in text and len(lines) == text.count('\n') + \
+            (not text.endswith('\n')):
+        return lines
+    return io.StringIO(text, newline=None)
+
+
+def _decode(blocks, encoding):
+    if encoding is None:
+        for block in blocks:
+            yield from _text_lines(_decode_block(block))
+        return
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    pending = ''
+    for block in blocks:
+        text = pending + decoder.decode(block)
+        stop = text.rfind('\n') + 1
+        pending = text[stop:]
+        yield from _text_lines(text[:stop])
+    yield from _text_lines(pending + decoder.decode(b'', True))
+
+
+def _split_blocks(data, block_size):
+    start, end = 0, len(data)
+    with memoryview(data) as view:
+        while start < end:
+            stop = data.find(b'\n', min(start + block_size, end) - 1,
+                             end) + 1 or end
+            with view[start:stop] as block:
+                yield block
+            start = stop
+
+
+def decode_lines(data, encoding=None, block_size=BLOCK_SIZE):
+    blocks = _split_blocks(data, block_size)
+    try:
+        yield from _decode(blocks, encoding or detect_encoding(data))
+    finally:
+        blocks.close()
+
+
+def read_blocks(f, block_size=BLOCK_SIZE):
+    parts = []
+    for data in iter(partial(f.read, block_size), b''):
+        stop = data.rfind(b'\n') + 1
+        if not stop:
+            parts.append(data)
+            continue
+        parts.append(data[:stop])
+        yield b''.join(parts)
+        parts = [data[stop:]]
+    if any(parts):
+        yield b''.join(parts)
+
+
+def decode_blocks(blocks, encoding=None):
+    blocks = iter(blocks)
+    first = next(blocks, None)
+    if first is None:
+        return
+    yield from _decode(chain((first,), blocks),
+                       encoding or detect_encoding(first))
+
+
+@contextlib.contextmanager
+def _map_lines(f, encoding):
+    if not os.fstat(f.fileno()).st_size:
+        yield iter(())
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        lines = decode_lines(data, encoding)
+        try:
+            yield lines
+        finally:
+            lines.close()
+
+
+@contextlib.contextmanager
+def _stream_lines(f, encoding):
+    lines = decode_blocks(read_blocks(f), encoding)
+    try:
+        yield lines
+    finally:
+        lines.close()
+
+
+@contextlib.contextmanager
+def open_page(filename, encoding=None):
+    with open(filename, 'rb') as f:
+        opener = detect_opener(f)
+        if opener is not None:
+            with opener(f, 'rb') as decompressed, \
+                    _stream_lines(decompressed, encoding) as lines:
+                yield lines
+        elif stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            with _map_lines(f, encoding) as lines:
+                yield lines
+        else:
+            with _stream_lines(f, encoding) as lines:
+                yield lines
+
+
+def read_page(filename):
+    with open_input(filename) as f:
+        return f.read()
+
+
+class TeeWriter(object):
+    def __init__(self, files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+
+@contextlib.contextmanager
+def open_output(filename, compress=False, keep=False):
+    files = []
+    try:
+        for name in output_files(filename, compress, keep):
+            if name == filename:
+                files.append(open(name, 'w', encoding='utf-8'))
+            else:
+                files.append(io.TextIOWrapper(
+                    gzip.GzipFile(name, 'wb', mtime=0), encoding='utf-8'))
+        yield files[0] if len(files) == 1 else TeeWriter(files)
+    finally:
+        for f in files:
+            f.close()
+
+
+def output_files(filename, compress=False, keep=False):
+    if not compress or keep:
+        yield filename
+    if compress:
+        yield filename + GZIP_SUFFIX
+
+
+def write_atomic(filename, text):
+    directory = os.path.dirname(filename) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, filename)
+    except BaseException:
+        os.remove(temp_path)
+        raise
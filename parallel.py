@@ -0,0 +1,127 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from utils import MAN2HTML
+from macros import MacroProcessor
+from xref import PageIndex
+from ir import parse, render_html
+
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_LINES = 2000
+CARRIED_STATE = ('pre_open', 'level1_open', 'level2_open', 'level3_open',
+                 'list_open', 'recording', 'closing_tags',
+                 'current_font_size', 'header_id')
+
+_converter = None
+
+
+def _init_worker(xref_filename, converter_class=MAN2HTML):
+    global _converter
+    xref = None if xref_filename is None else PageIndex(xref_filename)
+    _converter = converter_class(xref=xref, macros=False)
+
+
+def save_state(state):
+    return tuple(tuple(value) if isinstance(value, list) else value
+                 for value in (getattr(state, name)
+                               for name in CARRIED_STATE))
+
+
+def restore_state(state, saved):
+    for name, value in zip(CARRIED_STATE, saved):
+        setattr(state, name, list(value) if isinstance(value, tuple)
+                else value)
+
+
+def convert_chunk(converter, lines, start_state, page_path=None):
+    converter.reset(page_path=page_path)
+    restore_state(converter.state, start_state)
+    document = parse(converter, lines)
+    return document, save_state(converter.state)
+
+
+def _convert_chunk(task):
+    return convert_chunk(_converter, *task)
+
+
+class ParallelConverter(object):
+    def __init__(self, jobs=None, xref_filename=None,
+                 min_chunk_lines=MIN_CHUNK_LINES, converter_class=MAN2HTML):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.min_chunk_lines = min_chunk_lines
+        self.xref_filename = xref_filename
+        self.converter_class = converter_class
+        self.reconverted = 0
+        self._executor = None
+        xref = None if xref_filename is None else PageIndex(xref_filename)
+        self.converter = converter_class(xref=xref, macros=False)
+        self.macros = MacroProcessor(converter_class.BUILTIN_REQUESTS)
+
+    def split(self, lines):
+        header_tags = tuple(tag for tag, handler in
+                            self.converter_class.INLINE_FUNCTIONS.items()
+                            if handler == '_start_header')
+        chunk_lines = max(self.min_chunk_lines,
+                          len(lines) // (self.jobs * CHUNKS_PER_WORKER))
+        starts = [0]
+        for number, line in enumerate(lines):
+            if number - starts[-1] >= chunk_lines and \
+                    line.lstrip().startswith(header_tags):
+                starts.append(number)
+        return starts
+
+    def guess_states(self, lines, starts):
+        converter = self.converter_class(macros=False)
+        states = []
+        boundaries = iter(starts[1:] + [len(lines)])
+        boundary = 0
+        for number, line in enumerate(lines):
+            if number == boundary:
+                states.append(save_state(converter.state))
+                boundary = next(boundaries)
+            line = line.strip()
+            if line[:1] not in converter.REQUEST_STARTS:
+                continue
+            try:
+                converter.apply_request(
+                    converter.apply_not_closing_tags(line))
+            except (ValueError, IndexError):
+                pass
+        return states
+
+    def parse(self, text_lines, page_path=None):
+        self.macros.reset()
+        lines = list(self.macros.expand_lines(text_lines))
+        starts = self.split(lines)
+        self.reconverted = 0
+        if len(starts) == 1 or self.jobs == 1:
+            self.converter.reset(page_path=page_path)
+            return parse(self.converter, lines)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.jobs, initializer=_init_worker,
+                initargs=(self.xref_filename, self.converter_class))
+        states = self.guess_states(lines, starts)
+        chunks = [lines[start:end] for start, end in
+                  zip(starts, starts[1:] + [len(lines)])]
+        results = list(self._executor.map(
+            _convert_chunk, [(chunk, state, page_path)
+                             for chunk, state in zip(chunks, states)]))
+        for i in range(1, len(results)):
+            if states[i] != results[i - 1][1]:
+                self.reconverted += 1
+                results[i] = convert_chunk(self.converter, chunks[i],
+                                           results[i - 1][1], page_path)
+        document = results[0][0]
+        for chunk_document, _ in results[1:]:
+            document.extend(chunk_document)
+        return document
+
+    def man2html(self, text_lines, styles='', page_path=None):
+        document = self.parse(text_lines, page_path)
+        self.converter.reset(page_path=page_path)
+        return render_html(self.converter, document, styles)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
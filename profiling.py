@@ -0,0 +1,58 @@
+import heapq
+
+
+class StageProfiler(object):
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.stages = {}
+        self.lines = []
+        self.lines_count = 0
+
+    def record(self, stage, seconds, line_in, line_out):
+        counters = self.stages.get(stage)
+        if counters is None:
+            counters = self.stages[stage] = [0.0, 0, 0, 0]
+        counters[0] += seconds
+        counters[1] += 1
+        counters[2] += len(line_in)
+        counters[3] += len(line_out)
+
+    def record_line(self, number, seconds, line):
+        self.lines_count += 1
+        if self.slowest <= 0:
+            return
+        item = (seconds, number, line)
+        if len(self.lines) < self.slowest:
+            heapq.heappush(self.lines, item)
+        elif item > self.lines[0]:
+            heapq.heapreplace(self.lines, item)
+
+    def total(self):
+        return sum(counters[0] for counters in self.stages.values())
+
+    def slowest_lines(self):
+        return sorted(self.lines, reverse=True)
+
+    def report(self, out_file):
+        total = self.total() or 1
+        out_file.write('{:<24} {:>9} {:>11} {:>7} {:>9} {:>11} {:>11}\n'
+                       .format('stage', 'calls', 'total ms', 'share',
+                               'us/call', 'chars in', 'chars out'))
+        for stage, (seconds, calls, chars_in, chars_out) in \
+                self.stages.items():
+            out_file.write('{:<24} {:>9} {:>11.2f} {:>6.1f}% {:>9.2f} '
+                           '{:>11} {:>11}\n'.format(
+                               stage, calls, seconds * 1e3,
+                               seconds / total * 100,
+                               seconds / (calls or 1) * 1e6,
+                               chars_in, chars_out))
+        if not self.lines:
+            return
+        out_file.write('\nslowest {} of {} lines:\n'.format(
+            len(self.lines), self.lines_count))
+        for seconds, number, line in self.slowest_lines():
+            line = line.strip()
+            if len(line) > 60:
+                line = line[:57] + '...'
+            out_file.write('{:>8} {:>9.3f} ms  {}\n'.format(
+                number, seconds * 1e3, line))
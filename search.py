@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+import html
+import sqlite3
+from collections import namedtuple
+from argparse import ArgumentParser
+from ir import TAG_RE
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    section TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS anchors (
+    id INTEGER PRIMARY KEY,
+    page INTEGER NOT NULL,
+    anchor TEXT NOT NULL,
+    title TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS anchors_page ON anchors (page);
+CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5 (name, title, body);
+'''
+QUERY = '''
+SELECT pages.path, anchors.anchor, pages.name, pages.section, anchors.title,
+       snippet(terms, 2, '[', ']', '...', 12)
+FROM terms
+JOIN anchors ON anchors.id = terms.rowid
+JOIN pages ON pages.id = anchors.page
+WHERE terms MATCH ?
+ORDER BY bm25(terms, 10.0, 5.0, 1.0)
+LIMIT ?
+'''
+DEFAULT_LIMIT = 20
+
+SearchResult = namedtuple('SearchResult', ['path', 'anchor', 'name',
+                                           'section', 'title', 'snippet'])
+
+
+def get_arguments():
+    parser = ArgumentParser()
+    parser.add_argument('index', metavar='INDEX',
+                        help='Search index built by batch.py --search')
+    parser.add_argument('query', metavar='TERM', nargs='+',
+                        help='Terms every result has to contain')
+    parser.add_argument('-n', '--limit', dest='limit', type=int,
+                        default=DEFAULT_LIMIT,
+                        help='Maximum number of results')
+    parser.add_argument('-r', '--raw', dest='raw', action='store_true',
+                        help='Pass the query to sqlite FTS5 as is '
+                             '(OR, NOT, prefix*, "phrases", ...)')
+    args = parser.parse_args()
+    return args
+
+
+def html_text(line):
+    return html.unescape(TAG_RE.sub(' ', line)).strip()
+
+
+class SectionCollector(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sections = []
+        self._heading = None
+
+    def add_line(self, heading, line):
+        if heading is not self._heading or not self.sections:
+            self._heading = heading
+            if heading is None:
+                self.sections.append(('', '', []))
+            else:
+                self.sections.append((heading.name,
+                                      html_text(heading.title), []))
+        text = html_text(line)
+        if text:
+            self.sections[-1][2].append(text)
+
+    def finish_page(self, path, name, section):
+        sections = [(anchor, title, ' '.join(texts))
+                    for anchor, title, texts in self.sections if texts]
+        return path, name, section, sections
+
+
+class SearchIndex(object):
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+
+    def add_page(self, path, name, section, sections):
+        connection = self.connection
+        page = connection.execute('SELECT id FROM pages WHERE path = ?',
+                                  (path,)).fetchone()
+        if page is not None:
+            self._remove_page(page[0])
+        page_id = connection.execute(
+            'INSERT INTO pages (path, name, section) VALUES (?, ?, ?)',
+            (path, name, section)).lastrowid
+        for anchor, title, body in sections:
+            anchor_id = connection.execute(
+                'INSERT INTO anchors (page, anchor, title) VALUES (?, ?, ?)',
+                (page_id, anchor, title)).lastrowid
+            connection.execute(
+                'INSERT INTO terms (rowid, name, title, body) '
+                'VALUES (?, ?, ?, ?)', (anchor_id, name, title, body))
+
+    def _remove_page(self, page_id):
+        self.connection.execute(
+            'DELETE FROM terms WHERE rowid IN '
+            '(SELECT id FROM anchors WHERE page = ?)', (page_id,))
+        self.connection.execute('DELETE FROM anchors WHERE page = ?',
+                                (page_id,))
+        self.connection.execute('DELETE FROM pages WHERE id = ?', (page_id,))
+
+    def commit(self):
+        self.connection.commit()
+
+    def optimize(self):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO terms (terms) VALUES ('optimize')")
+
+    def search(self, query, limit=DEFAULT_LIMIT, raw=False):
+        if not raw:
+            query = ' '.join('"{}"'.format(term.replace('"', '""'))
+                             for term in query.split())
+            if not query:
+                return []
+        return [SearchResult(*row) for row in
+                self.connection.execute(QUERY, (query, limit))]
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    index = SearchIndex(arguments.index)
+    for result in index.search(' '.join(arguments.query), arguments.limit,
+                               arguments.raw):
+        link = result.path + ('#' + result.anchor if result.anchor else '')
+        print('{}({}) {} — {}'.format(result.name, result.section, link,
+                                      result.title))
+        print('    ' + result.snippet)
+    index.close()
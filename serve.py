@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+
+import os
+import re
+import gzip
+import time
+import zlib
+import asyncio
+import threading
+import email.utils
+from collections import OrderedDict
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from utils import MAN2HTML
+from pageio import COMPRESSION_SUFFIXES, open_page
+from sinks import open_bundle, inflate_entry, gzip_entry
+
+DEFAULT_CACHE_SIZE = 64 << 20
+MAX_HEADERS = 100
+PAGE_PATH_RE = re.compile(r'^/man/(\d[\w]*)/([^/]+?)(?:\.html)?$')
+BUNDLE_PREFIX = '/man/'
+CONTENT_TYPES = {'.css': 'text/css; charset=utf-8'}
+HTML_CONTENT_TYPE = 'text/html; charset=utf-8'
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+           404: 'Not Found', 405: 'Method Not Allowed',
+           431: 'Request Header Fields Too Large',
+           500: 'Internal Server Error'}
+
+_local = threading.local()
+
+
+def get_arguments():
+    parser = ArgumentParser()
+    parser.add_argument('sources', metavar='DIR', nargs='*',
+                        help='Man hierarchy to serve (e.g. /usr/share/man)')
+    parser.add_argument('-b', '--bundle', dest='bundles', metavar='FILE',
+                        action='append', default=[],
+                        help='Serve pages out of a bundle written by '
+                             'batch.py (checked before the hierarchies)')
+    parser.add_argument('-H', '--host', dest='host', default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', dest='port', type=int, default=8000,
+                        help='Port to listen on (default: 8000)')
+    parser.add_argument('-s', '--style', dest='style', metavar='FILE',
+                        help='Styles file (e.g. style.css)')
+    parser.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int,
+                        help='Number of rendering processes '
+                             '(default: all cores)')
+    parser.add_argument('--cache-size', dest='cache_size', metavar='MB',
+                        type=int, default=DEFAULT_CACHE_SIZE >> 20,
+                        help='Rendered pages cache size in megabytes')
+    args = parser.parse_args()
+    if not args.sources and not args.bundles:
+        parser.error('at least one DIR or --bundle is required')
+    return args
+
+
+def render_page(filename, styles=''):
+    converter = getattr(_local, 'converter', None)
+    if converter is None:
+        converter = _local.converter = MAN2HTML()
+    converter.reset()
+    with open_page(filename) as lines:
+        body = converter.man2html(lines, styles=styles).encode('utf-8')
+    return body, gzip.compress(body)
+
+
+class RenderedPage(object):
+    __slots__ = ('body', 'gzipped')
+
+    def __init__(self, body, gzipped):
+        self.body = body
+        self.gzipped = gzipped
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzipped)
+
+
+class RenderCache(object):
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+
+    def get(self, key):
+        page = self._pages.get(key)
+        if page is None:
+            self.misses += 1
+            return None
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return page
+
+    def put(self, key, page):
+        if page.size > self.max_size:
+            return
+        old_page = self._pages.pop(key, None)
+        if old_page is not None:
+            self.size -= old_page.size
+        self._pages[key] = page
+        self.size += page.size
+        while self.size > self.max_size:
+            _, evicted = self._pages.popitem(last=False)
+            self.size -= evicted.size
+
+
+class ManServer(object):
+    def __init__(self, sources, styles='', cache_size=DEFAULT_CACHE_SIZE,
+                 executor=None, jobs=None, bundles=(), styles_mtime=None):
+        self.sources = sources
+        self.bundles = [(open_bundle(filename), os.stat(filename).st_mtime)
+                        for filename in bundles]
+        self.styles = styles
+        self.styles_hash = zlib.crc32(styles.encode('utf-8'))
+        if styles_mtime is None:
+            styles_mtime = time.time() if styles else 0
+        self.styles_mtime = styles_mtime
+        self.cache = RenderCache(cache_size)
+        self.executor = executor or ProcessPoolExecutor(max_workers=jobs)
+        self._rendering = {}
+
+    def find_page(self, section, name):
+        if name.startswith('.'):
+            return None
+        for source in self.sources:
+            for directory in ('man' + section, 'man' + section[0]):
+                prefix = os.path.join(source, directory, name + '.' + section)
+                for suffix in ('',) + COMPRESSION_SUFFIXES:
+                    if os.path.isfile(prefix + suffix):
+                        return prefix + suffix
+        return None
+
+    def find_entry(self, path, match):
+        if match:
+            section, name = match.groups()
+            paths = ['man{}/{}.{}.html'.format(directory, name, section)
+                     for directory in (section, section[0])]
+        elif path.startswith(BUNDLE_PREFIX):
+            paths = [path[len(BUNDLE_PREFIX):]]
+        else:
+            return None
+        for bundle, mtime in self.bundles:
+            for entry_path in paths:
+                entry = bundle.entry(entry_path)
+                if entry is not None:
+                    return entry_path, entry, mtime
+        return None
+
+    def respond_entry(self, entry_path, entry, mtime, headers):
+        validators = {'ETag': '"{:x}-{:x}"'.format(entry.crc, entry.size),
+                      'Last-Modified': email.utils.formatdate(
+                          mtime, usegmt=True)}
+        if not_modified(headers, validators['ETag'], mtime):
+            return 304, validators, b''
+        response_headers = {'Content-Type': CONTENT_TYPES.get(
+            os.path.splitext(entry_path)[1], HTML_CONTENT_TYPE),
+            'Vary': 'Accept-Encoding'}
+        response_headers.update(validators)
+        if 'gzip' in headers.get('accept-encoding', ''):
+            response_headers['Content-Encoding'] = 'gzip'
+            return 200, response_headers, gzip_entry(entry)
+        return 200, response_headers, inflate_entry(entry)
+
+    async def render(self, filename, stat):
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        page = self.cache.get(key)
+        if page is not None:
+            return page
+        future = self._rendering.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, render_page,
+                                          filename, self.styles)
+            self._rendering[key] = future
+            future.add_done_callback(
+                lambda _: self._rendering.pop(key, None))
+        body, gzipped = await asyncio.shield(future)
+        page = RenderedPage(body, gzipped)
+        self.cache.put(key, page)
+        return page
+
+    async def respond(self, method, path, headers):
+        if method not in ('GET', 'HEAD'):
+            return 405, {}, b''
+        path = path.split('?', 1)[0]
+        match = PAGE_PATH_RE.match(path)
+        found = self.bundles and self.find_entry(path, match)
+        if found:
+            return self.respond_entry(*found, headers)
+        filename = match and self.find_page(*match.groups())
+        if not filename:
+            return 404, {}, b''
+        stat = os.stat(filename)
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        mtime = max(stat.st_mtime, self.styles_mtime)
+        validators = {'ETag': etag(key, self.styles_hash),
+                      'Last-Modified': email.utils.formatdate(
+                          mtime, usegmt=True)}
+        if not_modified(headers, validators['ETag'], mtime):
+            return 304, validators, b''
+        page = await self.render(filename, stat)
+        response_headers = {'Content-Type': HTML_CONTENT_TYPE,
+                            'Vary': 'Accept-Encoding'}
+        response_headers.update(validators)
+        body = page.body
+        if 'gzip' in headers.get('accept-encoding', ''):
+            response_headers['Content-Encoding'] = 'gzip'
+            body = page.gzipped
+        return 200, response_headers, body
+
+    async def handle(self, reader, writer):
+        try:
+            status, parts, headers = await read_request(reader)
+            if status is not None:
+                response_headers, body = {}, b''
+            else:
+                try:
+                    status, response_headers, body = await self.respond(
+                        parts[0], parts[1], headers)
+                except Exception:
+                    status, response_headers, body = 500, {}, b''
+            response_headers['Content-Length'] = str(len(body))
+            response_headers['Connection'] = 'close'
+            head = 'HTTP/1.1 {} {}\r\n'.format(status, REASONS[status]) + \
+                ''.join('{}: {}\r\n'.format(name, value)
+                        for name, value in response_headers.items())
+            writer.write(head.encode('latin-1') + b'\r\n')
+            if parts and parts[0] != 'HEAD':
+                writer.write(body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def read_request(reader):
+    try:
+        parts = (await reader.readline()).decode('latin-1').split()
+    except ValueError:
+        return 400, [], {}
+    headers = {}
+    try:
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+    except ValueError:
+        return 431, parts, headers
+    return None if len(parts) == 3 else 400, parts, headers
+
+
+def etag(key, styles_hash=0):
+    _, mtime_ns, size = key
+    return '"{:x}-{:x}-{}-{:x}"'.format(mtime_ns, size,
+                                        MAN2HTML.RULES_VERSION, styles_hash)
+
+
+def not_modified(headers, page_etag, mtime):
+    if 'if-none-match' in headers:
+        tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+        return page_etag in tags or '*' in tags
+    if 'if-modified-since' in headers:
+        try:
+            since = email.utils.parsedate_to_datetime(
+                headers['if-modified-since'])
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since.timestamp()
+    return False
+
+
+async def serve(server, host, port):
+    listener = await server.start(host, port)
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if arguments.style:
+        with open(arguments.style) as f:
+            styles = f.read()
+        styles_mtime = os.stat(arguments.style).st_mtime
+    else:
+        styles = ''
+        styles_mtime = 0
+    server = ManServer(arguments.sources, styles=styles,
+                       cache_size=arguments.cache_size << 20,
+                       jobs=arguments.jobs, bundles=arguments.bundles,
+                       styles_mtime=styles_mtime)
+    try:
+        asyncio.run(serve(server, arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
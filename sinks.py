@@ -0,0 +1,294 @@
+import io
+import os
+import abc
+import zlib
+import struct
+import sqlite3
+import zipfile
+import contextlib
+from collections import namedtuple
+from pageio import open_output, output_files, write_atomic
+
+BUFFER_SIZE = 1 << 20
+COMPRESS_LEVEL = 6
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_UTF8 = 0x800
+ZIP_DATE = (1 << 5) | 1
+ZIP_ATTRIBUTES = 0o100644 << 16
+ZIP_MAX_ENTRIES = 0xffff
+ZIP_MAX_OFFSET = 0xffffffff
+ZIP_MAGIC = b'PK'
+SQLITE_MAGIC = b'SQLite format 3\x00'
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_OFFSET = struct.Struct('<HHQ')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+GZIP_TRAILER = struct.Struct('<II')
+SCHEMA = '''
+CREATE TABLE entries (
+    path TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    crc INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+'''
+
+Entry = namedtuple('Entry', ['data', 'crc', 'size'])
+
+
+def compress_entry(data, level=COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return Entry(compressor.compress(data) + compressor.flush(),
+                 zlib.crc32(data), len(data))
+
+
+def inflate_entry(entry):
+    return zlib.decompress(entry.data, -zlib.MAX_WBITS)
+
+
+def gzip_entry(entry):
+    return GZIP_HEADER + entry.data + GZIP_TRAILER.pack(
+        entry.crc, entry.size & 0xffffffff)
+
+
+class Sink(abc.ABC):
+    bundle = True
+
+    @contextlib.contextmanager
+    def open(self, path):
+        buffer = io.StringIO()
+        yield buffer
+        self.write(path, buffer.getvalue())
+
+    def write(self, path, text):
+        self.write_entry(path, compress_entry(text.encode('utf-8')))
+
+    @abc.abstractmethod
+    def write_entry(self, path, entry):
+        pass
+
+    def remove(self, path):
+        pass
+
+    def drain(self):
+        return ()
+
+    def close(self):
+        pass
+
+    def abort(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class DirectorySink(Sink):
+    bundle = False
+
+    def __init__(self, directory, compress=False, keep=False):
+        self.directory = directory
+        self.compress = compress
+        self.keep = keep
+
+    def _target(self, path):
+        return os.path.join(self.directory, *path.split('/'))
+
+    @contextlib.contextmanager
+    def open(self, path):
+        target = self._target(path)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        with open_output(target, self.compress, self.keep) as f:
+            yield f
+
+    def write(self, path, text):
+        write_atomic(self._target(path), text)
+
+    def write_entry(self, path, entry):
+        self.write(path, inflate_entry(entry).decode('utf-8'))
+
+    def remove(self, path):
+        for filename in output_files(self._target(path), self.compress,
+                                     self.keep):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+class EntrySink(Sink):
+    def __init__(self):
+        self.entries = []
+
+    def write_entry(self, path, entry):
+        self.entries.append((path, entry))
+
+    def drain(self):
+        entries, self.entries = self.entries, []
+        return entries
+
+
+class ZipSink(Sink):
+    def __init__(self, filename):
+        self.filename = filename
+        self._temp_filename = filename + '.tmp'
+        self._file = open(self._temp_filename, 'wb', buffering=BUFFER_SIZE)
+        self._offset = 0
+        self._central = []
+
+    def write_entry(self, path, entry):
+        if max(len(entry.data), entry.size) >= ZIP_MAX_OFFSET:
+            raise ValueError('zip bundle entries are limited to 4 GiB, use '
+                             'a .sqlite bundle')
+        name = path.encode('utf-8')
+        self._file.write(LOCAL_HEADER.pack(
+            0x04034b50, ZIP_VERSION, ZIP_UTF8, zipfile.ZIP_DEFLATED, 0,
+            ZIP_DATE, entry.crc, len(entry.data), entry.size, len(name), 0))
+        self._file.write(name)
+        self._file.write(entry.data)
+        version, offset, extra = ZIP_VERSION, self._offset, b''
+        if offset >= ZIP_MAX_OFFSET:
+            version, offset = ZIP64_VERSION, ZIP_MAX_OFFSET
+            extra = ZIP64_OFFSET.pack(1, ZIP64_OFFSET.size - 4, self._offset)
+        self._central.append(CENTRAL_HEADER.pack(
+            0x02014b50, (3 << 8) | version, version, ZIP_UTF8,
+            zipfile.ZIP_DEFLATED, 0, ZIP_DATE, entry.crc, len(entry.data),
+            entry.size, len(name), len(extra), 0, 0, 0, ZIP_ATTRIBUTES,
+            offset) + name + extra)
+        self._offset += LOCAL_HEADER.size + len(name) + len(entry.data)
+
+    def close(self):
+        central = b''.join(self._central)
+        count = len(self._central)
+        self._file.write(central)
+        if count >= ZIP_MAX_ENTRIES or self._offset >= ZIP_MAX_OFFSET or \
+                len(central) >= ZIP_MAX_OFFSET:
+            self._file.write(ZIP64_END_RECORD.pack(
+                0x06064b50, ZIP64_END_RECORD.size - 12, ZIP64_VERSION,
+                ZIP64_VERSION, 0, 0, count, count, len(central),
+                self._offset))
+            self._file.write(ZIP64_LOCATOR.pack(
+                0x07064b50, 0, self._offset + len(central), 1))
+        self._file.write(END_RECORD.pack(
+            0x06054b50, 0, 0, min(count, ZIP_MAX_ENTRIES),
+            min(count, ZIP_MAX_ENTRIES), min(len(central), ZIP_MAX_OFFSET),
+            min(self._offset, ZIP_MAX_OFFSET), 0))
+        self._file.close()
+        os.replace(self._temp_filename, self.filename)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._temp_filename)
+
+
+class SqliteSink(Sink):
+    def __init__(self, filename):
+        self.filename = filename
+        self._temp_filename = filename + '.tmp'
+        if os.path.exists(self._temp_filename):
+            os.remove(self._temp_filename)
+        self.connection = sqlite3.connect(self._temp_filename)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.executescript(SCHEMA)
+
+    def write_entry(self, path, entry):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO entries (path, data, crc, size) '
+            'VALUES (?, ?, ?, ?)', (path,) + tuple(entry))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+        os.replace(self._temp_filename, self.filename)
+
+    def abort(self):
+        self.connection.close()
+        os.remove(self._temp_filename)
+
+
+BUNDLE_SINKS = {'.zip': ZipSink, '.sqlite': SqliteSink}
+
+
+def open_sink(output, compress=False, keep=False):
+    sink_class = BUNDLE_SINKS.get(os.path.splitext(output)[1])
+    if sink_class is None:
+        return DirectorySink(output, compress, keep)
+    return sink_class(output)
+
+
+class ZipBundle(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with zipfile.ZipFile(filename) as archive:
+            self._infos = {info.filename: info
+                           for info in archive.infolist()}
+        self._fd = os.open(filename, os.O_RDONLY)
+
+    def paths(self):
+        return sorted(self._infos)
+
+    def entry(self, path):
+        info = self._infos.get(path)
+        if info is None:
+            return None
+        header = os.pread(self._fd, LOCAL_HEADER.size, info.header_offset)
+        fields = LOCAL_HEADER.unpack(header)
+        offset = info.header_offset + LOCAL_HEADER.size + fields[-2] + \
+            fields[-1]
+        data = os.pread(self._fd, info.compress_size, offset)
+        if info.compress_type == zipfile.ZIP_STORED:
+            return compress_entry(data)
+        if info.compress_type != zipfile.ZIP_DEFLATED:
+            raise ValueError('unsupported compression in {}'.format(path))
+        return Entry(data, info.CRC, info.file_size)
+
+    def read(self, path):
+        entry = self.entry(path)
+        return None if entry is None else inflate_entry(entry)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SqliteBundle(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(
+            'file:{}?mode=ro'.format(filename), uri=True,
+            check_same_thread=False)
+
+    def paths(self):
+        return [path for path, in self.connection.execute(
+            'SELECT path FROM entries ORDER BY path')]
+
+    def entry(self, path):
+        row = self.connection.execute(
+            'SELECT data, crc, size FROM entries WHERE path = ?',
+            (path,)).fetchone()
+        return None if row is None else Entry(*row)
+
+    def read(self, path):
+        entry = self.entry(path)
+        return None if entry is None else inflate_entry(entry)
+
+    def close(self):
+        self.connection.close()
+
+
+def open_bundle(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(len(SQLITE_MAGIC))
+    if magic.startswith(ZIP_MAGIC):
+        return ZipBundle(filename)
+    if magic == SQLITE_MAGIC:
+        return SqliteBundle(filename)
+    raise ValueError('{} is not a zip or sqlite bundle'.format(filename))
@@ -1,14 +1,75 @@
 #!/usr/bin/python3
 
+import gc
+import io
+import os
+import math
+import bz2
+import gzip
+import lzma
+import time
+import tempfile
+import asyncio
+import threading
+import tracemalloc
+import zipfile
 import unittest
+import http.client
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import utils
 from utils import MAN2HTML
+import batch
+from cache import ConversionCache
+from xref import PageIndex
+from profiling import StageProfiler
+from serve import ManServer
+from search import SectionCollector, SearchIndex
+from parallel import ParallelConverter
+from macros import EXPAND_BATCH, MacroProcessor
+from compact import CompactMAN2HTML, stylesheet_directory, \
+    write_stylesheet
+from ir import TEXT, Document, parse, render_html, render_text
+from watch import PollingWatcher, Reconverter, batches
+from pageio import open_page, read_page, open_output
+from sinks import Sink, compress_entry, open_sink, open_bundle
 
 
 M2HO = MAN2HTML()
 M2H = partial(M2HO.man2html_base, record_all=True)
 
 
+def generate_page(lines_count):
+    yield '.TH BIG 1 "2020-01-01" "1.0" "Test"\n'
+    for i in range(lines_count):
+        if i % 1000 == 0:
+            yield '.SH "SECTION {}"\n'.format(i)
+        elif i % 10 == 0:
+            yield '.B bold {}\n'.format(i)
+        else:
+            yield '\\fBtext\\fR {} &lt;x&gt;\n'.format(i)
+
+
+def scaling_exponent(run, make_input, sizes, repeat=5):
+    inputs = [make_input(size) for size in sizes]
+    best = [float('inf')] * len(sizes)
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for i, data in enumerate(inputs):
+                start = time.process_time()
+                run(data)
+                best[i] = min(best[i], time.process_time() - start)
+    finally:
+        gc.enable()
+    points = [(math.log(size), math.log(seconds))
+              for size, seconds in zip(sizes, best)]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / \
+        sum((x - mean_x) ** 2 for x, _ in points)
+
+
 class TestMan2Html(unittest.TestCase):
     def test_links(self):
         self.assertEqual(M2HO.global_ref_selection('test http://google.com/ '
@@ -24,12 +85,46 @@ class TestMan2Html(unittest.TestCase):
         self.assertEqual(M2HO.local_ref_selection('gcc(12)'),
                          '<a href="gcc#12">gcc</a>(12)')
 
+    def test_links_hostile(self):
+        self.assertEqual(M2HO.global_ref_selection('a@b.com.x@c.org'),
+                         '<a href="mailto:a@b.com.x">a@b.com.x</a>@c.org')
+        self.assertEqual(M2HO.global_ref_selection(
+            'see ftp://x.org./a. and file:///usr/share/'),
+            'see <a href="ftp://x.org./a.">ftp://x.org./a.</a> and '
+            '<a href="file:///usr/share/">file:///usr/share/</a>')
+        converter = MAN2HTML()
+        for line in ('http://' + 'a-' * 5000 + '!', 'http://' + 'a.' * 5000,
+                     'a.' * 5000 + '@', 'a' * 5000 + '@' + 'b' * 5000,
+                     '@a' * 5000, 'x@' + 'a.' * 5000 + '1',
+                     ('a' * 9 + '@') * 1000):
+            start = time.perf_counter()
+            converter.global_ref_selection(line)
+            self.assertLess(time.perf_counter() - start, 0.1)
+
     def test_bold_single_line(self):
         self.assertEqual(M2H(['.B ls']), '<b>ls</b>')
 
     def test_italic_single_line(self):
         self.assertEqual(M2H(['.I ls']), '<i>ls</i>')
 
+    def test_bold_italic_single_line(self):
+        self.assertEqual(M2H(['.IB x']), '<b><i>x</i></b>')
+
+    def test_index_entry(self):
+        self.assertEqual(M2H(['.IX Item "a"']),
+                         '</div><div style="padding-left: 4em;">')
+
+    def test_request_without_space(self):
+        self.assertEqual(M2H(['.IXfoo']), '<i>Xfoo</i>')
+
+    def test_paragraph_request_without_space(self):
+        self.assertEqual(M2H(['.IPx']),
+                         '<h4 style="display:block;"></h4>'
+                         '<div style="padding-left: 4em;display:block;">')
+
+    def test_special_character_after_text(self):
+        self.assertEqual(M2H([r'(\(dq']), '("')
+
     def test_bold_multiple_line(self):
         self.assertEqual(M2H([r'123\fBls\fR']), '123<b>ls</b>')
         self.assertEqual(M2H([r'123\fBls\fP']), '123<b>ls</b>')
@@ -107,6 +202,604 @@ class TestMan2Html(unittest.TestCase):
         self.assertEqual(M2H(['a', '.br', 'b']).replace('\n', ''), 'a<br />b')
         self.assertEqual(M2H(['a', '.PP', 'b']).replace('\n', ''), 'a<br />b')
 
+    def test_classify_lines(self):
+        class FullMAN2HTML(MAN2HTML):
+            def classify_lines(self, lines):
+                return [utils.CONTROL] * len(lines)
+
+        page = ['.TH A 1', 'plain <text>', ' .B indented', r'a \fBb\fR',
+                'see ls(1)', 'mail a@b.org', 'C`quoted', '', '.nf',
+                'keep  spaces', '.fi', 'x.zZ y']
+        self.assertEqual(MAN2HTML().classify_lines(page), [
+            utils.CONTROL, utils.PLAIN, utils.CONTROL, utils.ESCAPES,
+            utils.REFS, utils.REFS, utils.ESCAPES, utils.PLAIN,
+            utils.CONTROL, utils.PLAIN, utils.CONTROL, utils.ESCAPES])
+        page.extend(generate_page(200))
+        self.assertEqual(MAN2HTML().man2html(page),
+                         FullMAN2HTML().man2html(page))
+
+    def test_macros(self):
+        def expand(lines):
+            return list(MacroProcessor(MAN2HTML.BUILTIN_REQUESTS)
+                        .expand_lines(lines))
+
+        self.assertEqual(expand([
+            '.ds Aq \\(aq', '.ds lq "quoted', '.ds long.name long',
+            'a\\*(Aqb \\*(lq \\*[long.name] \\*(xx', '.nr N 3',
+            '.nr N +2', 'n=\\nN \\\\*(Aq']),
+            ["a\\(aqb quoted long \\*(xx", 'n=5 \\\\*(Aq'])
+        self.assertEqual(expand([
+            '.de OPT', '.\\" comment', '.  RB [ \\\\$1 ]', '.  ad l',
+            '\\\\$2 text', '..', '.OPT --all "two words"', '.ig',
+            'hidden', '..', '.nop shown']),
+            ['.RB [ --all ]\n', 'two words text\n', 'shown\n'])
+        self.assertEqual(expand([
+            '.ie n \\{\\', 'nroff', '.\\}', '.el \\{\\', 'troff', '.\\}',
+            '.if t .B troff', '.if !\\n(.g .ad l', ".if '\\*(xx'' same",
+            '.if (1+2)*3=9 .B math', '.if n .sp', 'end']),
+            ['nroff', '.B math\n', 'end'])
+        self.assertEqual(expand(['.de R', '.R', '..', '.R', 'after']),
+                         ['after'])
+        self.assertEqual(expand([
+            '.TH A 1', '.de R', '.nr x +1', '.R', '.R', '..', '.R']),
+            ['.TH A 1'])
+        self.assertEqual(expand([
+            '.if {}1{} deep'.format('(' * 2000, ')' * 2000),
+            '.if {}1 signs'.format('-' * 5001), '.nr N {}1'.format(
+                '(' * 2000), '.if -(-2) .B minus']), ['.B minus\n'])
+        self.assertEqual(expand(['.ds a \\*a\\*a'] + [
+            '.as a \\*a'] * 20 + ['\\*a'])[0][:3], '\\*a')
+        processor = MacroProcessor()
+        preamble = ['.de X', '.B \\\\$1', '..', '.TH A 1']
+        self.assertEqual(list(processor.expand_lines(preamble + ['.X a'])),
+                         ['.TH A 1', '.B a\n'])
+        processor.reset()
+        self.assertEqual(list(processor.expand_lines(preamble + ['.X b'])),
+                         ['.TH A 1', '.B b\n'])
+        for condition, expected in (('n', 'x'), ('t', '.B t\n')):
+            processor.reset()
+            self.assertEqual(list(processor.expand_lines(
+                ['.TH A 1', '.ie {} .B n'.format(condition)] +
+                ['x'] * (EXPAND_BATCH - 2) + ['.el .B t', '.nr y 1']))[-1],
+                expected)
+        page = ['.TH A 1', '.ds T \\fBtitle\\fR', '\\*T', '.ig', 'x', '..']
+        self.assertIn('<b>title</b>', MAN2HTML().man2html(page))
+        self.assertNotIn('title', MAN2HTML(macros=False).man2html(page))
+        self.assertNotEqual(MAN2HTML().rules_version(),
+                            MAN2HTML(macros=False).rules_version())
+
+    def test_reset(self):
+        converter = MAN2HTML()
+        page = list(generate_page(2000))
+        converter.man2html(page)
+        converter.reset()
+        self.assertEqual(converter.man2html(page), MAN2HTML().man2html(page))
+
+    def test_profiler(self):
+        page = ['.de X', '.B \\\\$1', '..', '.ig', 'hidden', '..'] + list(
+            generate_page(500)) + ['plain text', 'see ls(1)', '.X a']
+        profiler = StageProfiler(slowest=3)
+        html = MAN2HTML(profiler=profiler).man2html(page)
+        self.assertEqual(html, MAN2HTML().man2html(page))
+        self.assertEqual(set(profiler.stages), set(MAN2HTML.STAGES))
+        self.assertEqual(profiler.stages['plain_line'][1], 1)
+        self.assertEqual(profiler.stages['refs_line'][1], 1)
+        self.assertEqual(profiler.stages['apply_part_tags'][1],
+                         len(page) - 8)
+        self.assertEqual(len(profiler.slowest_lines()), 3)
+        self.assertEqual(profiler.lines_count, len(page) - 6)
+        profiler = StageProfiler(slowest=len(page))
+        MAN2HTML(profiler=profiler).man2html(page)
+        numbers = {number: line for _, number, line in profiler.lines}
+        self.assertEqual(numbers[7], page[6])
+        self.assertEqual(numbers[len(page) - 1], 'see ls(1)')
+        self.assertEqual(numbers[len(page)], '.B a\n')
+        self.assertNotIn(1, numbers)
+
+    def test_stream(self):
+        page = list(generate_page(3000))
+        out = io.StringIO()
+        MAN2HTML().man2html_stream(iter(page), out, styles='b {}')
+        self.assertEqual(out.getvalue(),
+                         MAN2HTML().man2html(page, styles='b {}'))
+
+    def test_stream_memory(self):
+        with tempfile.TemporaryFile('w+') as out:
+            tracemalloc.start()
+            try:
+                MAN2HTML().man2html_stream(generate_page(100000), out)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertGreater(out.tell(), 2 * MAN2HTML.SPOOL_MAX_SIZE)
+        self.assertLess(peak, 2 * MAN2HTML.SPOOL_MAX_SIZE)
+
+    def test_stream_memory_compressed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'big.1.gz')
+            with gzip.open(filename, 'wt') as f:
+                f.writelines(generate_page(100000))
+            self.assertGreater(len(read_page(filename)),
+                               2 * MAN2HTML.SPOOL_MAX_SIZE)
+            with tempfile.TemporaryFile('w+') as out:
+                tracemalloc.start()
+                try:
+                    with open_page(filename) as lines:
+                        MAN2HTML().man2html_stream(lines, out)
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+        self.assertLess(peak, 2 * MAN2HTML.SPOOL_MAX_SIZE)
+
+    def test_scaling(self):
+        converter = MAN2HTML()
+
+        def convert(page):
+            converter.reset()
+            converter.man2html(page)
+
+        def headers_page(count):
+            page = ['.TH A 1']
+            for i in range(count):
+                page.extend(('.SH "H {}"'.format(i), '.SS "S {}"'.format(i),
+                             'text'))
+            return page
+
+        def macros_page(count):
+            page = ['.TH A 1', '.de M', '.B \\\\$1', '..', '.ds s \\fIs\\fR']
+            for i in range(count):
+                page.extend(('.M m{}'.format(i), '\\*s {}'.format(i)))
+            return page
+
+        stages = (
+            ('escapes per line', converter.apply_part_tags,
+             lambda count: r'\fBb\fIi\fP\fR ' * count,
+             (500, 1000, 2000, 4000)),
+            ('size changes per line', converter.change_font,
+             lambda count: r'a\s+2b\s-2 ' * count, (500, 1000, 2000, 4000)),
+            ('lines per page', convert, lambda count: list(
+                generate_page(count)), (1000, 2000, 4000, 8000)),
+            ('headers per page', convert, headers_page,
+             (250, 500, 1000, 2000)),
+            ('macro calls per page', convert, macros_page,
+             (250, 500, 1000, 2000)),
+        )
+        for name, run, make_input, sizes in stages:
+            with self.subTest(name):
+                self.assertLess(scaling_exponent(run, make_input, sizes), 1.3)
+
+    def test_batch(self):
+        page = list(generate_page(100))
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'man')
+            os.makedirs(os.path.join(source, 'man1'))
+            os.makedirs(os.path.join(source, 'man3'))
+            with open(os.path.join(source, 'man1', 'ls.1'), 'w') as f:
+                f.writelines(page)
+            with gzip.open(os.path.join(source, 'man3', 'cat.3.gz'),
+                           'wt') as f:
+                f.writelines(page)
+            with open(os.path.join(source, 'man3', 'broken.3.gz'), 'w') as f:
+                f.write('not gzip')
+            output = os.path.join(root, 'html')
+            tasks = list(batch.collect_pages([source], output))
+            results = {source: error for source, error, *_ in
+                       batch.convert_pages(tasks, jobs=2)}
+            self.assertIsNone(results[os.path.join(source, 'man1', 'ls.1')])
+            self.assertIsNone(results[os.path.join(source, 'man3',
+                                                   'cat.3.gz')])
+            self.assertTrue(results[os.path.join(source, 'man3',
+                                                 'broken.3.gz')])
+            self.assertEqual(sorted(os.listdir(os.path.join(output, 'man3'))),
+                             ['cat.3.html'])
+            with open(os.path.join(output, 'man1', 'ls.1.html')) as f:
+                self.assertEqual(f.read(), MAN2HTML().man2html(page))
+
+    def test_compact(self):
+        page = list(generate_page(100)) + [
+            '.SS Sub\n', '.IP "1." 4\n', '\\fBitem\\fR one\n', '.PP\n',
+            'end\n']
+        converter = CompactMAN2HTML()
+        converter.reset(page_path='man1/ls.1.html')
+        compact = converter.man2html(page)
+        default = MAN2HTML().man2html(page)
+        self.assertIn('href="../man.css"', compact)
+        self.assertNotIn('style=', compact)
+        self.assertLess(len(compact), len(default))
+        self.assertEqual(MAN2HTML().man2html(page), default)
+        self.assertEqual(stylesheet_directory('html/man1/ls.1.html',
+                                              'man1/ls.1.html'), 'html')
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'man', 'man1')
+            os.makedirs(source)
+            with open(os.path.join(source, 'ls.1'), 'w') as f:
+                f.writelines(page)
+            output = os.path.join(root, 'html')
+            tasks = list(batch.collect_pages([os.path.dirname(source)],
+                                             output))
+            write_stylesheet(output)
+            list(batch.convert_pages(tasks, jobs=1, output=output,
+                                     compact=True))
+            with open(os.path.join(output, 'man1', 'ls.1.html')) as f:
+                self.assertEqual(f.read(), compact)
+            with open(os.path.join(output, 'man.css')) as f:
+                self.assertIn('.p4{padding-left:4em}', f.read())
+
+    def test_sinks(self):
+        page = list(generate_page(100))
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'man', 'man1')
+            os.makedirs(source)
+            for name in ('ls.1', 'cat.1'):
+                with open(os.path.join(source, name), 'w') as f:
+                    f.writelines(page)
+            with open(os.path.join(source, 'broken.1'), 'wb') as f:
+                f.write(b'\xff' * 10)
+            for name in ('pages.zip', 'pages.sqlite'):
+                output = os.path.join(root, name)
+                tasks = list(batch.collect_pages(
+                    [os.path.dirname(source)], output))
+                with open_sink(output) as sink:
+                    sink.write('man.css', 'b {}')
+                    for _, _, _, _, entries in batch.convert_pages(
+                            tasks, jobs=2, output=output, bundle=True):
+                        for path, entry in entries:
+                            sink.write_entry(path, entry)
+                self.assertFalse(os.path.exists(output + '.tmp'))
+                bundle = open_bundle(output)
+                self.assertEqual(bundle.paths(), [
+                    'man.css', 'man1/cat.1.html', 'man1/ls.1.html'])
+                self.assertEqual(bundle.read('man1/ls.1.html').decode(),
+                                 MAN2HTML().man2html(page))
+                self.assertIsNone(bundle.entry('man1/cp.1.html'))
+                bundle.close()
+                server = ManServer([], executor=ThreadPoolExecutor(1),
+                                   bundles=[output])
+                status, headers, body = asyncio.run(server.respond(
+                    'GET', '/man/1/ls', {'accept-encoding': 'gzip'}))
+                self.assertEqual(status, 200)
+                self.assertEqual(gzip.decompress(body).decode(),
+                                 MAN2HTML().man2html(page))
+                self.assertEqual(asyncio.run(server.respond(
+                    'GET', '/man/1/ls', {'if-none-match': headers['ETag']}))[
+                    0], 304)
+                status, headers, body = asyncio.run(server.respond(
+                    'GET', '/man/man.css', {}))
+                self.assertEqual((headers['Content-Type'][:8], body),
+                                 ('text/css', b'b {}'))
+            with zipfile.ZipFile(os.path.join(root, 'pages.zip')) as archive:
+                self.assertIsNone(archive.testzip())
+            output = os.path.join(root, 'many.zip')
+            entry = compress_entry(b'x')
+            with open_sink(output) as sink:
+                for i in range(0x10000):
+                    sink.write_entry('{}.html'.format(i), entry)
+            with zipfile.ZipFile(output) as archive:
+                self.assertEqual(len(archive.infolist()), 0x10000)
+            bundle = open_bundle(output)
+            self.assertEqual(bundle.read('65535.html'), b'x')
+            bundle.close()
+            with self.assertRaises(TypeError):
+                Sink()
+
+    def test_cache(self):
+        def document(text):
+            result = Document()
+            result.append(TEXT, text * 1000)
+            return result
+
+        size = len(document('x').dumps())
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConversionCache(directory, max_size=2.5 * size)
+            key = cache.key(b'.B ls')
+            self.assertNotEqual(key, cache.key(b'.I ls'))
+            self.assertNotEqual(key, cache.key(b'.B ls', rules='0'))
+            self.assertNotEqual(key, cache.key(b'.B ls', encoding='koi8-r'))
+            self.assertIsNone(cache.get_document(key))
+            cache.put_document(key, document('x'))
+            cache.put_document(cache.key(b'2'), document('y'))
+            self.assertEqual(cache.get_document(key).payloads, ['x' * 1000])
+            cache.put_document(cache.key(b'3'), document('z'))
+            self.assertEqual(cache.stats(),
+                             {'hits': 1, 'misses': 1, 'evictions': 1})
+            self.assertEqual(cache.get_document(key).payloads, ['x' * 1000])
+            self.assertIsNone(cache.get_document(cache.key(b'2')))
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConversionCache(directory, max_size=2.5 * size)
+            for text in ('x', 'y'):
+                cache.put_document(cache.key(b'.B ls'), document(text))
+            self.assertEqual(cache._size, size)
+
+    def test_document(self):
+        page = list(generate_page(100)) + [
+            'text \x00f40\x00 here \x00o1\x00', '.SS Sub', '.IP "1." 4',
+            r'\fBitem\fR one', '.Vb', '  x &lt; 1', '.Ve', '.PP', 'end', '.SM',
+            '.IX Item "a"', r'\s+2big\s0', r'\&tail']
+        converter = MAN2HTML()
+        document = parse(converter, page)
+        self.assertIn('start_subheader', document.kind_names)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ConversionCache(directory)
+            key = cache.key(b''.join(line.encode() for line in page))
+            self.assertIsNone(cache.get_document(key))
+            cache.put_document(key, document)
+            document = cache.get_document(key)
+        for styles in ('', 'b { color: red; }'):
+            self.assertEqual(render_html(MAN2HTML(), document, styles),
+                             MAN2HTML().man2html(page, styles=styles))
+        self.assertEqual(render_html(CompactMAN2HTML(), document),
+                         CompactMAN2HTML().man2html(page))
+        self.assertEqual(Document.loads(document.dumps()).dumps(),
+                         document.dumps())
+        text = render_text(document).splitlines()
+        self.assertEqual(text[2], 'SECTION 0')
+        self.assertEqual(text[-10:-2], ['', '   Sub', '       1. item one',
+                                        '       x < 1', '', '       end', '',
+                                        '       big tail'])
+
+    def test_watch(self):
+        page = ['.TH LS 1\n', '.SH NAME\n', 'ls \\- see cat(1)\n']
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'man', 'man1')
+            os.makedirs(source)
+            ls = os.path.join(source, 'ls.1')
+            with open(ls, 'w') as f:
+                f.writelines(page)
+            pwd = os.path.join(source, 'pwd.1')
+            with open(pwd, 'w') as f:
+                f.write('.TH PWD 1\npwd \\- see true(1)\n')
+            output = os.path.join(root, 'html')
+            reconverter = Reconverter([os.path.join(root, 'man')], output,
+                                      xref_filename=os.path.join(root, 'db'))
+            self.assertEqual(reconverter.convert_all(), [ls, pwd])
+            self.assertEqual(reconverter.referrers['cat'], {ls})
+            watcher = PollingWatcher([os.path.join(root, 'man')], 0.01)
+            changes = batches(watcher, debounce=0.05)
+            cat = os.path.join(source, 'cat.1')
+            with open(cat, 'w') as f:
+                f.writelines(page)
+            self.assertEqual(next(changes), {cat})
+            self.assertEqual(reconverter.update({cat}), [cat, ls])
+            with open(os.path.join(output, 'man1', 'ls.1.html')) as f:
+                self.assertIn('<a href="cat.1.html">cat</a>(1)', f.read())
+            os.remove(cat)
+            self.assertEqual(next(changes), {cat})
+            self.assertEqual(reconverter.update({cat}), [ls])
+            self.assertEqual(sorted(os.listdir(os.path.join(output, 'man1'))),
+                             ['ls.1.html', 'pwd.1.html'])
+            with open(ls, 'a') as f:
+                f.write('.B new\n')
+            os.utime(ls, ns=(0, 0))
+            self.assertEqual(reconverter.update(next(changes)), [ls])
+            with open(os.path.join(output, 'man1', 'ls.1.html')) as f:
+                self.assertIn('<b>new</b>', f.read())
+            reconverter.converter.xref.close()
+
+    def test_xref(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'index.db')
+            PageIndex.build(filename, [('ls', '1', 'man1/ls.1.html'),
+                                       ('SSL_read', '3ssl',
+                                        'man3/SSL_read.3ssl.html')])
+            xref = PageIndex(filename)
+            converter = MAN2HTML(xref=xref)
+            converter.reset(page_path='man3/stat.3.html')
+            self.assertEqual(converter.local_ref_selection(
+                '<b>ls</b>(1), SSL_read(3), bash(1), ls(12)'),
+                '<b><a href="../man1/ls.1.html">ls</a></b>(1), '
+                '<a href="SSL_read.3ssl.html">SSL_read</a>(3), '
+                'bash(1), ls(12)')
+            xref.close()
+
+    def test_search(self):
+        page = ['.TH LS 1', '.SH NAME', r'ls \- list directory contents',
+                '.SH OPTIONS', r'\fB\-R\fR list subdirectories '
+                'recursively', '.SS Sorting', 'sort by &lt;time&gt;']
+        collector = SectionCollector()
+        converter = MAN2HTML(indexer=collector)
+        html = converter.man2html(page)
+        self.assertEqual(html, MAN2HTML().man2html(page))
+        records = collector.finish_page('man1/ls.1.html', 'ls', '1')
+        self.assertEqual([section[:2] for section in records[3]],
+                         [('header-1', 'NAME'), ('header-2', 'OPTIONS'),
+                          ('header-3', 'Sorting')])
+        with tempfile.TemporaryDirectory() as directory:
+            index = SearchIndex(os.path.join(directory, 'search.db'))
+            index.add_page(*records)
+            index.add_page(*records)
+            index.commit()
+            self.assertEqual(
+                [result[:4] for result in index.search('RECURSIVELY list')],
+                [('man1/ls.1.html', 'header-2', 'ls', '1')])
+            self.assertEqual(index.search('<time>')[0].anchor, 'header-3')
+            self.assertEqual(index.search('contents')[0].anchor, 'header-1')
+            self.assertEqual(index.search('missing'), [])
+            index.close()
+
+    def test_parallel(self):
+        page = list(generate_page(3000))
+        page[1500:1500] = [r'\fBunclosed \s+2bigger', '.SS sub', '.IP x',
+                           '.Vb', 'pre', '.Ve']
+        page[2999:2999] = ['.Vb', '.SH "INSIDE PRE"', 'text']
+        converter = ParallelConverter(jobs=2, min_chunk_lines=500)
+        try:
+            self.assertEqual(converter.man2html(page, styles='b {}'),
+                             MAN2HTML().man2html(page, styles='b {}'))
+            self.assertGreater(len(converter.split(page)), 2)
+            self.assertTrue(converter.reconverted)
+            self.assertEqual(converter.man2html(page[:100]),
+                             MAN2HTML().man2html(page[:100]))
+        finally:
+            converter.close()
+
+        class SectionAlias(MAN2HTML):
+            INLINE_FUNCTIONS = dict(MAN2HTML.INLINE_FUNCTIONS,
+                                    **{'.Sh': '_start_header'})
+
+        page = [line.replace('.SH', '.Sh') for line in page]
+        converter = ParallelConverter(jobs=2, min_chunk_lines=500,
+                                      converter_class=SectionAlias)
+        self.assertGreater(len(converter.split(page)), 2)
+
+    def test_pageio(self):
+        def read_lines(filename):
+            with open_page(filename) as lines:
+                return ''.join(lines)
+
+        page = '.TH LS 1\n.SH NAME\n\\fBls\\fR \\- list\n'
+        with tempfile.TemporaryDirectory() as directory:
+            for name, opener in (('ls.1', open), ('ls.1.gz', gzip.open),
+                                 ('ls.1.bz2', bz2.open),
+                                 ('ls.1.xz', lzma.open),
+                                 ('ls.1.txt', gzip.open)):
+                filename = os.path.join(directory, name)
+                with opener(filename, 'wt') as f:
+                    f.write(page)
+                with open_page(filename) as lines:
+                    self.assertEqual(''.join(lines), page)
+                self.assertEqual(read_page(filename), page.encode('utf-8'))
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                fifo = os.path.join(directory, 'fifo')
+                for reader in (read_lines,
+                               lambda name: read_page(name).decode('utf-8')):
+                    os.mkfifo(fifo)
+                    with ThreadPoolExecutor(1) as executor:
+                        result = executor.submit(reader, fifo)
+                        with open(fifo, 'wb') as f:
+                            f.write(data)
+                        self.assertEqual(result.result(), page)
+                    os.remove(fifo)
+            filename = os.path.join(directory, 'ls.1.html')
+            with open_page(os.path.join(directory, 'ls.1.xz')) as lines, \
+                    open_output(filename, compress=True, keep=True) as f:
+                MAN2HTML().man2html_stream(lines, f)
+            html = MAN2HTML().man2html(page.splitlines(True))
+            with open(filename) as f:
+                self.assertEqual(f.read(), html)
+            with gzip.open(filename + '.gz', 'rt') as f:
+                self.assertEqual(f.read(), html)
+
+    def test_encoding(self):
+        text = '.TH CAFÉ 1\n.SH NAME\ncafé \\- ç < ñ\n'
+        pages = (
+            ("'\\\" -*- coding: latin-1 -*-\n" + text, 'latin-1', None),
+            (".\\\" -*- mode: nroff; coding: iso-8859-15-unix -*-\n" + text,
+             'iso-8859-15', None),
+            (text, 'latin-1', None),
+            (text, 'cp1252', 'cp1252'),
+            ('\ufeff' + text, 'utf-8', None),
+            (text, 'utf-8', None),
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'cafe.1')
+            for page, encoding, explicit in pages:
+                with open(filename, 'w', encoding=encoding) as f:
+                    f.write(page)
+                with open_page(filename, explicit) as lines:
+                    self.assertEqual(''.join(lines), page.lstrip('\ufeff'))
+            with open(filename, 'wb') as f:
+                f.write(b'.TH A 1\n\xe9t\xe9\n\xc3\xa9t\xc3\xa9')
+            with open_page(filename) as lines:
+                self.assertEqual(list(lines), ['.TH A 1\n', 'été\n', 'été'])
+            page = text * 2000
+            for encoding in ('utf-16', 'utf-32'):
+                with open(filename, 'w', encoding=encoding) as f:
+                    f.write(page)
+                with open_page(filename, encoding) as lines:
+                    self.assertEqual(''.join(lines), page)
+            open(filename, 'w').close()
+            with open_page(filename) as lines:
+                self.assertEqual(list(lines), [])
+        self.assertIn('ç &lt; ñ', MAN2HTML().man2html(text.splitlines()))
+
+    def test_cache_encoding(self):
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'man1', 'enc.1')
+            os.mkdir(os.path.dirname(source))
+            with open(source, 'wb') as f:
+                f.write(b'.TH ENC 1\n\xe9t\xe9\n')
+            output = os.path.join(root, 'html')
+            cache = os.path.join(root, 'cache')
+            target = os.path.join(output, 'man1', 'enc.1.html')
+            for encoding, text in ((None, 'été'), ('koi8-r', 'ИtИ')):
+                tasks = [(source, target)]
+                list(batch.convert_pages(tasks, jobs=1, output=output,
+                                         cache_directory=cache,
+                                         encoding=encoding))
+                with open(target, encoding='utf-8') as f:
+                    self.assertIn(text, f.read())
+
+    def test_serve(self):
+        page = ['.TH LS 1', '.SH NAME', r'\fBls\fR \- list']
+        with tempfile.TemporaryDirectory() as source:
+            os.mkdir(os.path.join(source, 'man1'))
+            with gzip.open(os.path.join(source, 'man1', 'ls.1.gz'),
+                           'wt') as f:
+                f.write('\n'.join(page))
+            server = ManServer([source], cache_size=1 << 20,
+                               executor=ThreadPoolExecutor(2))
+            loop = asyncio.new_event_loop()
+            listener = loop.run_until_complete(server.start(port=0))
+            port = listener.sockets[0].getsockname()[1]
+            thread = threading.Thread(target=loop.run_forever)
+            thread.start()
+
+            def request(path, method='GET', **headers):
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                connection.close()
+                return response, body
+
+            try:
+                response, body = request('/man/1/ls',
+                                         **{'Accept-Encoding': 'gzip'})
+                self.assertEqual(response.status, 200)
+                self.assertEqual(response.getheader('Content-Encoding'),
+                                 'gzip')
+                self.assertEqual(gzip.decompress(body).decode('utf-8'),
+                                 MAN2HTML().man2html(page))
+                etag = response.getheader('ETag')
+                response, body = request('/man/1/ls', 'HEAD')
+                self.assertEqual((response.status, body), (200, b''))
+                self.assertEqual(response.getheader('ETag'), etag)
+                response, _ = request('/man/1/ls', **{'If-None-Match': etag})
+                self.assertEqual(response.status, 304)
+                modified = response.getheader('Last-Modified')
+                response, _ = request('/man/1/ls', **{
+                    'If-Modified-Since': modified})
+                self.assertEqual(response.status, 304)
+                for path in ('/man/1/cat', '/man/1/..', '/etc/passwd'):
+                    self.assertEqual(request(path)[0].status, 404)
+                self.assertEqual(request('/man/1/' + 'x' * 70000)[0].status,
+                                 400)
+                self.assertEqual(request('/man/1/ls', Cookie='x' * 70000)[0]
+                                 .status, 431)
+                self.assertEqual((server.cache.hits, server.cache.misses),
+                                 (1, 1))
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                listener.close()
+                loop.run_until_complete(listener.wait_closed())
+                loop.close()
+                server.executor.shutdown()
+            styled = ManServer([source], styles='b {}',
+                               executor=ThreadPoolExecutor(1),
+                               styles_mtime=time.time() + 60)
+            status, headers, body = asyncio.run(styled.respond(
+                'GET', '/man/1/ls', {'if-none-match': etag}))
+            self.assertEqual(status, 200)
+            self.assertNotEqual(headers['ETag'], etag)
+            self.assertIn(b'b {}', body)
+            self.assertEqual(asyncio.run(styled.respond(
+                'GET', '/man/1/ls', {'if-modified-since': modified}))[0], 200)
+            self.assertEqual(asyncio.run(styled.respond(
+                'GET', '/man/1/ls', {'if-modified-since': headers[
+                    'Last-Modified']}))[0], 304)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,48 +1,90 @@
 import re
 import shlex
+import time
+import shutil
+import bisect
+import tempfile
+from types import MappingProxyType
+from itertools import accumulate, chain, islice
 from collections import namedtuple
+from macros import MacroProcessor
 
+PLAIN, REFS, ESCAPES, CONTROL = range(4)
 
-def _compare(item):
-    return -len(item[0])
+
+def _alternation(tags):
+    return re.compile('|'.join(
+        re.escape(tag) for tag in sorted(tags, key=len, reverse=True)))
 
 Info = namedtuple('Info', ['name', 'num', 'date', 'ver'])
 Heading = namedtuple('Heading', ['name', 'title', 'level'])
 
 
+class DocumentState(object):
+    __slots__ = ('page_path', 'pre_open', 'level1_open', 'level2_open',
+                 'level3_open', 'list_open', 'info', 'recording',
+                 'closing_tags', 'current_font_size', 'header_id', 'headers',
+                 'page_title', 'request')
+
+    def reset(self, page_path=None, font_size=10):
+        self.page_path = page_path
+        self.pre_open = False
+        self.level1_open = False
+        self.level2_open = False
+        self.level3_open = False
+        self.list_open = False
+        self.info = None
+        self.recording = False
+        self.closing_tags = []
+        self.current_font_size = font_size
+        self.header_id = 0
+        self.headers = []
+        self.page_title = ''
+        self.request = None
+
+
 class MAN2HTML(object):
+    RULES_VERSION = '5'
     DEFAULT_FONT_SIZE = 10
-
-    HEADER = '''
-<html>
-  <head>
-    <meta charset="utf-8" />
-    <style>
-      * {{
+    DEFAULT_INDENT = 4
+    SPOOL_MAX_SIZE = 1 << 20
+    SPOOL_CHUNK_SIZE = 1 << 16
+    CLASSIFY_BATCH = 512
+    DISPLAY_STYLES = ('display:block;', 'display:inline;')
+
+    STYLESHEET = '''\
+      * {
         font-size: 10pt;
-      }}
-      .left-block {{
+      }
+      .left-block {
         width: 33%;
         float: left;
         text-align: left;
-      }}
-      .center-block {{
+      }
+      .center-block {
         width: 33%;
         float: left;
         text-align: center;
-      }}
-      .right-block {{
+      }
+      .right-block {
         width: 33%;
         float: left;
         text-align: right;
-      }}
-      i {{
+      }
+      i {
         color: #f99;
-      }}
-      ul {{
+      }
+      ul {
         list-style-type: none;
-      }}
-{}
+      }
+'''
+    HEADER = '''
+<html>
+  <head>
+    <meta charset="utf-8" />
+    <style>
+''' + \
+        STYLESHEET.replace('{', '{{').replace('}', '}}') + '''{}
     </style>
   </head>
   <body>
@@ -54,353 +96,599 @@ class MAN2HTML(object):
 </html>
 '''
 
+    def _display_attribute(self, inline):
+        return 'style="{}"'.format(self.DISPLAY_STYLES[inline])
+
+    def _indent_attribute(self, padding, inline=None):
+        display = '' if inline is None else self.DISPLAY_STYLES[inline]
+        return 'style="padding-left: {}em;{}"'.format(padding, display)
+
+    def _font_open(self, size):
+        return self.FONT_CHANGING_OPEN.format(size)
+
     def _start_paragraph(self, data):
-        closing = '</div><br />' if self.level3_open else ''
-        self.level3_open = True
+        closing = '</div><br />' if self.state.level3_open else ''
+        self.state.level3_open = True
         parts = re.search(r'"(.*)" (\d+)', data)
-        inline_style = 'display:block;'
+        inline = False
         if parts is None:
-            part1, part2 = '', ''
+            part1, part2 = '', self.DEFAULT_INDENT
         else:
             part1, part2 = parts.group(1), parts.group(2)
             if (part1[-1] == '.' and part1[:-1].isnumeric()) or \
                len(part1[-1]) == 1:
-                inline_style = 'display:inline;'
+                inline = True
                 part2 = 0
-        return '{}<h4 style="{}">{}</h4><div ' \
-               'style="padding-left: {}em;{}">'\
-            .format(closing, inline_style, part1, part2, inline_style)
+        return '{}<h4 {}>{}</h4><div {}>'.format(
+            closing, self._display_attribute(inline), part1,
+            self._indent_attribute(part2, inline))
 
     def _start_subheader(self, data):
-        closing = '</div><br />' if self.level3_open else ''
-        closing += '</div>' if self.level2_open else ''
-        self.level3_open = False
-        self.level2_open = True
+        closing = '</div><br />' if self.state.level3_open else ''
+        closing += '</div>' if self.state.level2_open else ''
+        self.state.level3_open = False
+        self.state.level2_open = True
         parts = re.search(r'"(.*)"', data)
         if parts is None:
             result = data.split(' ', 2)[1]
         else:
             result = parts.group(1)
-        return '{}<h3 id="{}">{}</h2><div style="padding-left: 3em;">'\
-            .format(closing, self.get_header_name(result, 2), result)
+        return '{}<h3 id="{}">{}</h2><div {}>'.format(
+            closing, self.get_header_name(result, 2), result,
+            self._indent_attribute(3))
 
     def _start_header(self, data):
-        closing = '</div><br />' if self.level3_open else ''
-        closing += '</div>' if self.level2_open else ''
-        closing += '</div>' if self.level1_open else ''
-        self.level3_open = False
-        self.level2_open = False
-        self.level1_open = True
+        closing = '</div><br />' if self.state.level3_open else ''
+        closing += '</div>' if self.state.level2_open else ''
+        closing += '</div>' if self.state.level1_open else ''
+        self.state.level3_open = False
+        self.state.level2_open = False
+        self.state.level1_open = True
         parts = re.search(r'"(.*)"', data)
         if parts is None:
             result = data.split(' ', 1)[1]
         else:
             result = parts.group(1)
-        return '{}<h2 id="{}">{}</h2><div style="padding-left: 3em;">'\
-            .format(closing, self.get_header_name(result, 1), result)
+        return '{}<h2 id="{}">{}</h2><div {}>'.format(
+            closing, self.get_header_name(result, 1), result,
+            self._indent_attribute(3))
 
     def _pad_right(self, length):
         try:
             length = int(length.strip())
         except:
             length = 1
-        return '<div style="padding-left: {}em;">'.format(length)
+        return '<div {}>'.format(self._indent_attribute(length))
 
     def _pad_left(self, data):
         return '</div>'
 
     def _start_pre(self, data):
-        self._pre_open = True
+        self.state.pre_open = True
         return '<pre>'
 
     def _finish_pre(self, data):
-        self._pre_open = False
+        self.state.pre_open = False
         return '</pre>'
 
     def _main_title(self, data):
-        self.recording = True
+        self.state.recording = True
         data_items = shlex.split(data)[:4]
         while len(data_items) < 4:
             data_items.append('')
-        self.info = Info(*data_items)
-        header1 = '{} ({})'.format(self.info.name, self.info.num)
+        info = self.state.info = Info(*data_items)
+        header1 = '{} ({})'.format(info.name, info.num)
         header2 = 'General Commands Manual'
-        self._page_title = '<div><h1 class="left-block">{0}</h1>' \
-                           '<h1 class="center-block">{1}</h1>' \
-                           '<h1 class="right-block">{0}</h1></div>'\
+        self.state.page_title = '<div><h1 class="left-block">{0}</h1>' \
+                                '<h1 class="center-block">{1}</h1>' \
+                                '<h1 class="right-block">{0}</h1></div>'\
             .format(header1, header2)
         return ''
 
     def _main_footer(self):
-        header1 = '{} ({})'.format(self.info.name, self.info.num)
+        info = self.state.info
+        header1 = '{} ({})'.format(info.name, info.num)
         return '<div><h1 class="left-block">{0}</h1><h1 class="center-' \
                'block">{1}</h1><h1 class="right-block">{2}</h1></div>'\
-            .format(self.info.ver, self.info.date, header1)
+            .format(info.ver, info.date, header1)
 
     def _start_title(self, data):
-        self.recording = True
+        self.state.recording = True
         return r'<h1 class="TH">{}</h1>'.format(data)
 
+    REQUEST_STARTS = ('.', '\\')
+    ESCAPE = '\\'
+    REF_MARKERS = ('(', '@', '://')
+    MODIFY_STAGES = ('apply_not_closing_tags', 'apply_part_tags',
+                     'change_font', 'apply_request', 'local_ref_selection',
+                     'global_ref_selection')
+    STAGES = ('expand_macros', 'classify_lines', 'plain_line',
+              'refs_line') + MODIFY_STAGES
+    REF_STAGES = ('local_ref_selection', 'global_ref_selection')
+
     FONT_CHANGING_TAGS = [
         re.compile(r'\\s(\+|\-)?(\d+)'),
     ]
     FONT_CHANGING_OPEN = '</span><span style="font-size:{}pt;">'
-    LOCAL_REF_RE1 = re.compile(r'(?<=<i>)([A-Za-z0-9-]*?)</i>\((\d+)\)')
-    LOCAL_REF_RE2 = re.compile(r'(?<=<b>)([A-Za-z0-9-]*?)</b>\((\d+)\)')
-    LOCAL_REF_RE3 = re.compile(r'([A-Za-z0-9-]*?)\((\d+)\)')
-
-    GLOBAL_REF_RE = re.compile(r'(https?://|ftp://|file:///)([A-Z0-9\-~]+'
-                               r'\.?/?)+', re.IGNORECASE)
-    MAILTO_REF_RE = re.compile(r'([a-z0-9_\.-]+)@([\da-z\.-]+)'
-                               r'\.([a-z\.]{2,6})', re.IGNORECASE)
-
-    def __init__(self):
-        self._pre_open = False
-        self.level1_open = False
-        self.level2_open = False
-        self.level3_open = False
-        self.list_open = False
-        self.info = None
-        self.recording = False
-        self.closing_tags = []
-        self.current_font_size = self.DEFAULT_FONT_SIZE
-        self._header_id = 0
-        self._headers = []
-        self._page_title = ''
-
-        self.INLINE_FUNCTIONS = {
-            r'.IP': self._start_paragraph,
-            r'.SH': self._start_header,
-            r'.Sh': self._start_header,
-            r'.RS': self._pad_right,
-            r'.RE': self._pad_left,
-            r'.SS': self._start_subheader,
-            r'.Vb': self._start_pre,
-            r'.Ve': self._finish_pre,
-            r'.TH': self._main_title,
-            r'.Dt': self._start_title,
-        }
-        self.INLINE_TAGS = sorted({
-            r'.de': r'',
-            r'.ds': r'',
-            r'.nr': r'',
-            r'.}f': r'',
-            r'.ll': r'',
-            r'.in': r'',
-            r'.ti': r'',
-            r'.el': r'',
-            r'.ie': r'',
-            r'..': r'',
-            r'.if': r'',
-            r'.nh': r'',
-            r'.zY': r'',
-            r'.LP': r'<br />',
-            r'.IB': r'<b><i>{}</i></b>',
-            '.FN': '<i>{}</i>',
-            r'.SM': r'<span style="font-size: 9pt;"></span>',
-            r'.RB': r'<b>{}</b>',
-            r'.PD': r'<!--{}-->',
-            r'.\"': r'<!--{}-->',
-            r'.B': r'<b>{}</b>',
-            r'\.B': r'<b>{}</b>',
-            r'.BR': r'<b>{}</b>',
-            r'.I': r'<i>{}</i>',
-            r'.IR': r'<i>{}</i>',
-            r'.PP': r'<br />',
-            r'.P': r'<br />',
-            r'.TP': r'<br />',
-            r'.br': r'<br />',
-            r'.IX ': r'</div><div style="padding-left: 4em;">',
-            r'\&': r'<span style="margin-right: 1em">{}</span>',
-        }.items(), key=_compare)
-        self.TEXT_PART_TAGS = {
-            r'\fB': r'<b>',
-            r'\f(BI': r'<span class=BI">',
-            r'\f(IB': r'<span class=IB">',
-            r'\f(CW': r'<span class="CW">',
-            r'\f(CI': r'<span class="CI">',
-            r'\f(CB': r'<span class="CB">',
-            r'\fI': r'<i>',
-        }
-        self.CLOSING_TAGS = {
-            r'\fB': r'</b>',
-            r'\f(BI': r'</span>',
-            r'\f(IB': r'</span>',
-            r'\f(CW': r'</span>',
-            r'\f(CI': r'</span>',
-            r'\f(CB': r'</span>',
-            r'\fI': r'</i>',
-        }
-        self.CLOSING_TAG_VARIANTS = [r'\fR']
-        self.CLOSING_ALL_TAG_VARIANTS = [r'\fP']
-        self.NOT_CLOSING_PART_TAGS = sorted({
-            r'\(dq': '"',
-            r'\(bv': r'|',
-            r'.zZ': r'',
-            r'\\$1': r'',
-            r'\*(L"': '"',
-            r'\*(R"': '"',
-            r'.nf': r'<p>',
-            r'.fi': r'</p>',
-            r'\(co': r'©',
-            r'.Os': '',
-            r'\|': r'',
-            r'\`': '`',
-            r'("': r'"',
-            r'\-': r'-',
-            r'.Sp': r'<br />',
-            r'C`': r'"',
-            r"C'": r'"',
-            r'\*(': r'',
-            r'\|_': r'_',
-            # r'\(bu': r'<b>.</b>',
-            r'\fB\f(BI': r'<span class="BI">',
-            r'\fB\f(CB': r'<span class="CB">',
-            r'\fB\fR': r'</span>',
-            r'\e': '\\',
-            r'\(aq': "'",
-            r'\(bu': '\u2022',
-        }.items(), key=_compare)
+    LOCAL_REF_RE = re.compile(r'(<([ib])>)?(?<![A-Za-z0-9_+.-])'
+                              r'([A-Za-z0-9_+-]+(?:\.[A-Za-z0-9_+-]+)*)'
+                              r'(?(1)</\2>)\((\d+)\)')
+
+    GLOBAL_REF_RE = re.compile(r'(?:https?://|ftp://|file:///)'
+                               r'[A-Z0-9\-~]+(?:(?:\./?|/)[A-Z0-9\-~]+)*'
+                               r'(?:\./?|/)?', re.IGNORECASE)
+    MAILTO_LOCAL_RE = re.compile(r'[a-z0-9_\.-]*', re.IGNORECASE)
+    MAILTO_DOMAIN_RE = re.compile(r'[\da-z\.-]*', re.IGNORECASE)
+    MAILTO_TOP_DOMAIN_RE = re.compile(r'[a-z\.]{2,6}', re.IGNORECASE)
+
+    INLINE_FUNCTIONS = MappingProxyType({
+        r'.IP': '_start_paragraph',
+        r'.SH': '_start_header',
+        r'.Sh': '_start_header',
+        r'.RS': '_pad_right',
+        r'.RE': '_pad_left',
+        r'.SS': '_start_subheader',
+        r'.Vb': '_start_pre',
+        r'.Ve': '_finish_pre',
+        r'.TH': '_main_title',
+        r'.Dt': '_start_title',
+    })
+    INLINE_TAGS = MappingProxyType({
+        r'.de': r'',
+        r'.ds': r'',
+        r'.nr': r'',
+        r'.}f': r'',
+        r'.ll': r'',
+        r'.in': r'',
+        r'.ti': r'',
+        r'.el': r'',
+        r'.ie': r'',
+        r'..': r'',
+        r'.if': r'',
+        r'.nh': r'',
+        r'.zY': r'',
+        r'.LP': r'<br />',
+        r'.IB': r'<b><i>{}</i></b>',
+        '.FN': '<i>{}</i>',
+        r'.SM': r'<span style="font-size: 9pt;"></span>',
+        r'.RB': r'<b>{}</b>',
+        r'.PD': r'<!--{}-->',
+        r'.\"': r'<!--{}-->',
+        r'.B': r'<b>{}</b>',
+        r'\.B': r'<b>{}</b>',
+        r'.BR': r'<b>{}</b>',
+        r'.I': r'<i>{}</i>',
+        r'.IR': r'<i>{}</i>',
+        r'.PP': r'<br />',
+        r'.P': r'<br />',
+        r'.TP': r'<br />',
+        r'.br': r'<br />',
+        r'.IX ': r'</div><div style="padding-left: 4em;">',
+        r'\&': r'<span style="margin-right: 1em">{}</span>',
+    })
+    THEMED_TAGS = (r'.SM', r'.IX ', r'\&')
+    TEXT_PART_TAGS = MappingProxyType({
+        r'\fB': r'<b>',
+        r'\f(BI': r'<span class=BI">',
+        r'\f(IB': r'<span class=IB">',
+        r'\f(CW': r'<span class="CW">',
+        r'\f(CI': r'<span class="CI">',
+        r'\f(CB': r'<span class="CB">',
+        r'\fI': r'<i>',
+    })
+    CLOSING_TAGS = MappingProxyType({
+        r'\fB': r'</b>',
+        r'\f(BI': r'</span>',
+        r'\f(IB': r'</span>',
+        r'\f(CW': r'</span>',
+        r'\f(CI': r'</span>',
+        r'\f(CB': r'</span>',
+        r'\fI': r'</i>',
+    })
+    CLOSING_TAG_VARIANTS = (r'\fR',)
+    CLOSING_ALL_TAG_VARIANTS = (r'\fP',)
+    NOT_CLOSING_PART_TAGS = MappingProxyType({
+        r'\(dq': '"',
+        r'\(bv': r'|',
+        r'.zZ': r'',
+        r'\\$1': r'',
+        r'\*(L"': '"',
+        r'\*(R"': '"',
+        r'.nf': r'<p>',
+        r'.fi': r'</p>',
+        r'\(co': r'©',
+        r'.Os': '',
+        r'\|': r'',
+        r'\`': '`',
+        r'("': r'"',
+        r'\-': r'-',
+        r'.Sp': r'<br />',
+        r'C`': r'"',
+        r"C'": r'"',
+        r'\*(': r'',
+        r'\|_': r'_',
+        # r'\(bu': r'<b>.</b>',
+        r'\fB\f(BI': r'<span class="BI">',
+        r'\fB\f(CB': r'<span class="CB">',
+        r'\fB\fR': r'</span>',
+        r'\e': '\\',
+        r'\(aq': "'",
+        r'\(bu': '\u2022',
+    })
+    HTML_ESCAPES = MappingProxyType({
+        '<': '&lt;',
+        '>': '&gt;',
+    })
+
+    def __init__(self, xref=None, profiler=None, indexer=None, macros=True):
+        self.xref = xref
+        self.profiler = profiler
+        self.indexer = indexer
+        self.macros = MacroProcessor(self.BUILTIN_REQUESTS) if macros else None
+        self.state = DocumentState()
+        self.reset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile_rules()
+
+    @classmethod
+    def compile_rules(cls):
+        cls.BUILTIN_REQUESTS = frozenset(
+            tag[1:].strip() for tag in chain(
+                cls.INLINE_FUNCTIONS, cls.INLINE_TAGS,
+                cls.NOT_CLOSING_PART_TAGS) if tag[:1] == '.')
+        cls.REQUEST_LENGTHS = tuple(sorted(
+            {len(tag) for tag in cls.INLINE_FUNCTIONS} |
+            {len(tag) for tag in cls.INLINE_TAGS}, reverse=True))
+        cls.PART_TAGS_RE = _alternation(
+            tuple(cls.TEXT_PART_TAGS) + cls.CLOSING_TAG_VARIANTS +
+            cls.CLOSING_ALL_TAG_VARIANTS)
+        cls.NOT_CLOSING_REPLACEMENTS = MappingProxyType(dict(
+            cls.NOT_CLOSING_PART_TAGS, **cls.HTML_ESCAPES))
+        cls.NOT_CLOSING_RE = _alternation(cls.NOT_CLOSING_REPLACEMENTS)
+        cls.HTML_ESCAPES_RE = _alternation(cls.HTML_ESCAPES)
+        cls.FONT_CHANGING_RE = re.compile('|'.join(
+            '(?:{})'.format(tag.pattern) for tag in cls.FONT_CHANGING_TAGS))
+        escape_tags = {tag for tag in chain(
+            cls.NOT_CLOSING_PART_TAGS, cls.TEXT_PART_TAGS,
+            cls.CLOSING_TAG_VARIANTS, cls.CLOSING_ALL_TAG_VARIANTS)
+            if cls.ESCAPE not in tag}
+        cls.LINE_CLASS_RE = re.compile('|'.join(chain(
+            [r'\n[^\S\n]*[{}].*'.format(
+                re.escape(''.join(cls.REQUEST_STARTS)))],
+            (re.escape(tag) + '.*' for tag in sorted(
+                escape_tags | {cls.ESCAPE}, key=lambda tag: (-len(tag), tag))),
+            (re.escape(marker) for marker in cls.REF_MARKERS))))
+
+    def reset(self, page_path=None):
+        self.state.reset(page_path, self.DEFAULT_FONT_SIZE)
+        if self.macros is not None:
+            self.macros.reset()
+        if self.indexer is not None:
+            self.indexer.reset()
+
+    def rules_version(self):
+        version = self.RULES_VERSION
+        if self.macros is None:
+            version += '-nomacros'
+        if self.xref is None:
+            return version
+        return '{}:{}:{}'.format(version, self.xref.fingerprint,
+                                 self.state.page_path)
 
     @property
     def header_id(self):
-        self._header_id += 1
-        return self._header_id
+        self.state.header_id += 1
+        return self.state.header_id
 
     def get_header_name(self, title, level):
         name = 'header-{}'.format(self.header_id)
-        self._headers.append(Heading(name, title, level))
+        self.state.headers.append(Heading(name, title, level))
         return name
 
     def get_contents(self):
-        result = '<div class="contents">'
-        for i in range(len(self._headers)):
-            if i == 0 or self._headers[i].level > self._headers[i - 1].level:
-                result += '<ul>'
-            if self._headers[i].level < self._headers[i - 1].level:
-                result += '</ul>'
-            result += '<li><a href="#{}">{}</a></li>'\
-                .format(self._headers[i].name, self._headers[i].title)
-        result += '</ul></div>'
-        return result
+        headers = self.state.headers
+        parts = ['<div class="contents">']
+        for i, header in enumerate(headers):
+            if i == 0 or header.level > headers[i - 1].level:
+                parts.append('<ul>')
+            if header.level < headers[i - 1].level:
+                parts.append('</ul>')
+            parts.append('<li><a href="#{}">{}</a></li>'.format(
+                header.name, header.title))
+        parts.append('</ul></div>')
+        return ''.join(parts)
+
+    def _replace_local_ref(self, match):
+        tag, name, section = match.group(2, 3, 4)
+        if self.xref is None:
+            href = '{}#{}'.format(name, section)
+        else:
+            href = self.xref.resolve(name, section, self.state.page_path)
+            if href is None:
+                return match.group(0)
+        if tag is None:
+            return '<a href="{}">{}</a>({})'.format(href, name, section)
+        return '<{0}><a href="{1}">{2}</a></{0}>({3})'.format(
+            tag, href, name, section)
 
     def local_ref_selection(self, line):
-        line = re.sub(self.LOCAL_REF_RE1,
-                      r'<a href="\g<1>#\g<2>">\g<1></a></i>(\g<2>)', line)
-        line = re.sub(self.LOCAL_REF_RE2,
-                      r'<a href="\g<1>#\g<2>">\g<1></a></b>(\g<2>)', line)
-        return re.sub(self.LOCAL_REF_RE3,
-                      r'<a href="\g<1>#\g<2>">\g<1></a>(\g<2>)', line)
+        if '(' not in line:
+            return line
+        return self.LOCAL_REF_RE.sub(self._replace_local_ref, line)
+
+    def _mailto_end(self, line, at):
+        domain_end = self.MAILTO_DOMAIN_RE.match(line, at + 1).end()
+        dot = line.rfind('.', at + 2, domain_end)
+        while dot >= 0:
+            top_domain = self.MAILTO_TOP_DOMAIN_RE.match(line, dot + 1)
+            if top_domain:
+                return top_domain.end()
+            dot = line.rfind('.', at + 2, dot)
+        return None
+
+    def mailto_ref_selection(self, line):
+        parts = []
+        end = bound = 0
+        at = line.find('@')
+        while at >= 0:
+            start = at - self.MAILTO_LOCAL_RE.match(line[bound:at][::-1]).end()
+            address_end = self._mailto_end(line, at) if start < at else None
+            if address_end is None:
+                bound = at + 1
+                at = line.find('@', bound)
+                continue
+            address = line[start:address_end]
+            parts.append(line[end:start])
+            parts.append('<a href="mailto:{0}">{0}</a>'.format(address))
+            end = bound = address_end
+            at = line.find('@', end)
+        parts.append(line[end:])
+        return ''.join(parts)
 
     def global_ref_selection(self, line):
-        line = re.sub(self.GLOBAL_REF_RE, r'<a href="\g<0>">\g<0></a>', line)
-        return re.sub(self.MAILTO_REF_RE, r'<a href="mailto:\g<0>">\g<0></a>',
-                      line)
+        if '://' in line:
+            line = self.GLOBAL_REF_RE.sub(r'<a href="\g<0>">\g<0></a>', line)
+        if '@' in line:
+            line = self.mailto_ref_selection(line)
+        return line
 
     def update_font(self, positions):
         if positions.group(2) == '0':
-            self.current_font_size = self.DEFAULT_FONT_SIZE
+            self.state.current_font_size = self.DEFAULT_FONT_SIZE
         else:
-            self.current_font_size += int(positions.group(1) +
-                                          positions.group(2))
+            self.state.current_font_size += int(positions.group(1) +
+                                                positions.group(2))
+
+    def _replace_font_tag(self, match):
+        text = match.group(0)
+        for tag in self.FONT_CHANGING_TAGS:
+            positions = tag.fullmatch(text)
+            if positions is not None:
+                self.update_font(positions)
+                break
+        return self._font_open(self.state.current_font_size)
 
     def change_font(self, line):
-        while True:
-            replace_data = ''
-            replace_position = len(line)
-            best_positions = None
-            for tag in self.FONT_CHANGING_TAGS:
-                positions = re.search(tag, line)
-                if positions is None:
-                    continue
-                replace_group = positions.group(0)
-                if line.index(replace_group) < replace_position:
-                    best_positions = positions
-                    replace_position = line.index(replace_group)
-                    replace_data = replace_group
-            if not replace_data:
-                return line
-            self.update_font(best_positions)
-            line = line.replace(replace_data,
-                                self.FONT_CHANGING_OPEN.format(
-                                    self.current_font_size), 1)
-        return line
+        return self.FONT_CHANGING_RE.sub(self._replace_font_tag, line)
 
-    def apply_part_tags_once(self, line):
-        min_pos, current_tag = len(line), ''
-
-        for tag in self.TEXT_PART_TAGS:
-            if tag in line:
-                if line.index(tag) < min_pos:
-                    min_pos = line.index(tag)
-                    current_tag = tag
-
-        for tag in self.CLOSING_ALL_TAG_VARIANTS:
-            if tag in line and line.index(tag) < min_pos:
-                result = ''
-                while self.closing_tags:
-                    result += self.closing_tags.pop(-1)
-                return line.replace(tag, result, 1)
-
-        for CLOSING_TAG in self.CLOSING_TAG_VARIANTS:
-            if CLOSING_TAG in line and line.index(CLOSING_TAG) < min_pos:
-                if len(self.closing_tags) > 0:
-                    result = self.closing_tags.pop(-1)
-                else:
-                    result = '</.....>'
-                return line.replace(CLOSING_TAG, result, 1)
+    def _replace_part_tag(self, match):
+        tag = match.group(0)
+        if tag in self.CLOSING_ALL_TAG_VARIANTS:
+            result = ''.join(reversed(self.state.closing_tags))
+            del self.state.closing_tags[:]
+            return result
 
-        if not current_tag:
-            return line
+        if tag in self.CLOSING_TAG_VARIANTS:
+            if len(self.state.closing_tags) > 0:
+                return self.state.closing_tags.pop(-1)
+            return '</.....>'
+
+        if len(self.state.closing_tags) > 0 and \
+           self.state.closing_tags[-1] == self.CLOSING_TAGS[tag] and \
+           self.state.closing_tags[-1] == '</i>':
+            return ''
 
-        if len(self.closing_tags) > 0 and \
-           self.closing_tags[-1] == self.CLOSING_TAGS[current_tag] and \
-           self.closing_tags[-1] == '</i>':
-            return line.replace(current_tag, '', 1)
+        self.state.closing_tags.append(self.CLOSING_TAGS[tag])
+        return self.TEXT_PART_TAGS[tag]
 
-        self.closing_tags.append(self.CLOSING_TAGS[current_tag])
-        return line.replace(current_tag, self.TEXT_PART_TAGS[current_tag], 1)
+    def _replace_not_closing_tag(self, match):
+        return self.NOT_CLOSING_REPLACEMENTS[match.group(0)]
 
     def apply_not_closing_tags(self, line):
-        for tag, result in self.NOT_CLOSING_PART_TAGS:
-            line = line.replace(tag, result)
-        return line
+        return self.NOT_CLOSING_RE.sub(self._replace_not_closing_tag, line)
 
     def apply_part_tags(self, line):
-        while True:
-            new_line = self.apply_part_tags_once(line)
-            if line == new_line:
-                break
-            line = new_line
-        return line
+        return self.PART_TAGS_RE.sub(self._replace_part_tag, line)
+
+    def request_tag(self, line):
+        if line[:1] not in self.REQUEST_STARTS:
+            return None
+        for length in self.REQUEST_LENGTHS:
+            tag = line[:length]
+            if tag in self.INLINE_FUNCTIONS or tag in self.INLINE_TAGS:
+                return tag
+        return None
+
+    def apply_request(self, line):
+        tag = self.state.request = self.request_tag(line)
+        if tag is None:
+            return line
+        if tag in self.INLINE_FUNCTIONS:
+            handler = getattr(self, self.INLINE_FUNCTIONS[tag])
+            return handler(line[len(tag):])
+        return self.INLINE_TAGS[tag].format(line[len(tag):].strip())
 
     def modify_line(self, line):
         line = line.strip()
         line = self.apply_not_closing_tags(line)
         line = self.apply_part_tags(line)
         line = self.change_font(line)
-        for tag, func in self.INLINE_FUNCTIONS.items():
-            if line.startswith(tag):
-                line = func(line[len(tag):])
-        for tag, result in self.INLINE_TAGS:
-            if line.startswith(tag):
-                line = result.format(line[len(tag):].strip())
-        if not self._pre_open:
+        line = self.apply_request(line)
+        if not self.state.pre_open:
             line = self.local_ref_selection(line)
             line = self.global_ref_selection(line)
         return line
 
+    def _profiled_stage(self, stage, line):
+        start = time.perf_counter()
+        new_line = getattr(self, stage)(line)
+        self.profiler.record(stage, time.perf_counter() - start, line,
+                             new_line)
+        return new_line
+
+    def _profiled_modify_line(self, line):
+        line = line.strip()
+        for stage in self.MODIFY_STAGES:
+            if stage in self.REF_STAGES and self.state.pre_open:
+                continue
+            line = self._profiled_stage(stage, line)
+        return line
+
+    def _profiled_expand_lines(self, text_lines):
+        profiler = self.profiler
+        text_lines = iter(text_lines)
+        number = 1
+        batch = list(islice(text_lines, self.CLASSIFY_BATCH))
+        while batch:
+            origins = []
+            start = time.perf_counter()
+            lines = self.macros.expand(batch, origins)
+            profiler.record('expand_macros', time.perf_counter() - start,
+                            ''.join(batch), ''.join(lines))
+            for origin, line in zip(origins, lines):
+                yield number + origin, line
+            number += len(batch)
+            batch = list(islice(text_lines, self.CLASSIFY_BATCH))
+
+    def _profiled_convert_lines(self, text_lines, record_all):
+        profiler = self.profiler
+        if self.macros is None:
+            numbered_lines = enumerate(text_lines, 1)
+        else:
+            numbered_lines = self._profiled_expand_lines(text_lines)
+        batch = list(islice(numbered_lines, self.CLASSIFY_BATCH))
+        while batch:
+            lines = [line for _, line in batch]
+            start = time.perf_counter()
+            classes = self.classify_lines(lines)
+            profiler.record('classify_lines', time.perf_counter() - start,
+                            ''.join(lines), '')
+            for (number, line), line_class in zip(batch, classes):
+                start = time.perf_counter()
+                if line_class == PLAIN:
+                    new_line = self._profiled_stage('plain_line', line)
+                elif line_class == REFS:
+                    new_line = self._profiled_stage('refs_line', line)
+                else:
+                    new_line = self._profiled_modify_line(line)
+                profiler.record_line(number, time.perf_counter() - start,
+                                     line)
+                if self.state.recording or record_all:
+                    yield new_line
+            batch = list(islice(numbered_lines, self.CLASSIFY_BATCH))
+
+    def _indexed_lines(self, lines):
+        indexer = self.indexer
+        headers = self.state.headers
+        for line in lines:
+            indexer.add_line(headers[-1] if headers else None, line)
+            yield line
+
+    def classify_lines(self, lines):
+        classes = [CONTROL if line[:1] in self.REQUEST_STARTS else
+                   ESCAPES if self.ESCAPE in line else PLAIN
+                   for line in lines]
+        rest = [number for number, line_class in enumerate(classes)
+                if line_class == PLAIN]
+        starts = list(accumulate((len(lines[number]) + 1 for number in rest),
+                                 initial=1))
+        text = '\n' + '\n'.join([lines[number] for number in rest])
+        for match in self.LINE_CLASS_RE.finditer(text):
+            number = rest[bisect.bisect_right(starts, match.start() + 1) - 1]
+            token = match.group()
+            if token[0] == '\n':
+                classes[number] = CONTROL
+            elif token in self.REF_MARKERS:
+                classes[number] = max(classes[number], REFS)
+            elif classes[number] < ESCAPES:
+                classes[number] = ESCAPES
+        return classes
+
+    def plain_line(self, line):
+        self.state.request = None
+        return self.HTML_ESCAPES_RE.sub(self._replace_not_closing_tag,
+                                        line.strip())
+
+    def refs_line(self, line):
+        line = self.plain_line(line)
+        if not self.state.pre_open:
+            line = self.local_ref_selection(line)
+            line = self.global_ref_selection(line)
+        return line
+
+    def _convert_lines(self, text_lines, record_all):
+        text_lines = iter(text_lines)
+        batch = list(islice(text_lines, self.CLASSIFY_BATCH))
+        while batch:
+            for line, line_class in zip(batch, self.classify_lines(batch)):
+                if line_class == PLAIN:
+                    new_line = self.plain_line(line)
+                elif line_class == REFS:
+                    new_line = self.refs_line(line)
+                else:
+                    new_line = self.modify_line(line)
+                if self.state.recording or record_all:
+                    yield new_line
+            batch = list(islice(text_lines, self.CLASSIFY_BATCH))
+
+    def convert_lines(self, text_lines, record_all=False):
+        if self.profiler is not None:
+            lines = self._profiled_convert_lines(text_lines, record_all)
+        else:
+            if self.macros is not None:
+                text_lines = self.macros.expand_lines(text_lines)
+            lines = self._convert_lines(text_lines, record_all)
+        if self.indexer is not None:
+            lines = self._indexed_lines(lines)
+        return lines
+
     def man2html_base(self, text_lines, record_all=False):
-        result_lines = []
-        for line in text_lines:
-            line = line.replace('<', '&lt;').replace('>', '&gt;')
-            new_line = self.modify_line(line)
-            if self.recording or record_all:
-                result_lines.append(new_line)
-        return '\n'.join(result_lines)
+        return '\n'.join(self.convert_lines(text_lines, record_all))
+
+    def page_header(self, styles=''):
+        return self.HEADER.format(styles)
+
+    def page_beginning(self, styles=''):
+        return self.page_header(styles) + self.state.page_title + \
+            self.get_contents()
+
+    def page_ending(self):
+        return '</div></span>' + self._main_footer() + self.FOOTER
 
     def man2html(self, text_lines, styles=''):
         data = self.man2html_base(text_lines)
-        beginning = self.HEADER.format(styles) + self._page_title + \
-            self.get_contents() + data
-        return beginning + '</div></span>' + self._main_footer() + self.FOOTER
+        return self.page_beginning(styles) + data + self.page_ending()
+
+    def man2html_stream(self, text_lines, out_file, styles=''):
+        with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE,
+                                           mode='w+', encoding='utf-8',
+                                           newline='') as body:
+            chunk, chunk_size, separator = [], 0, ''
+            for line in self.convert_lines(text_lines):
+                chunk.append(separator)
+                chunk.append(line)
+                chunk_size += len(line) + 1
+                separator = '\n'
+                if chunk_size >= self.SPOOL_CHUNK_SIZE:
+                    body.write(''.join(chunk))
+                    chunk, chunk_size = [], 0
+            body.write(''.join(chunk))
+            out_file.write(self.page_beginning(styles))
+            body.seek(0)
+            shutil.copyfileobj(body, out_file, self.SPOOL_CHUNK_SIZE)
+        out_file.write(self.page_ending())
+
+
+MAN2HTML.compile_rules()
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import defaultdict
+from argparse import ArgumentParser
+from utils import MAN2HTML
+from xref import PageIndex, split_page_name
+from batch import collect_pages, index_pages, page_path, page_target, \
+    strip_compression
+from pageio import open_page, write_atomic
+
+DEBOUNCE = 0.05
+POLL_INTERVAL = 0.5
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE
+EVENT = struct.Struct('iIII')
+READ_SIZE = 1 << 16
+
+
+def get_arguments():
+    parser = ArgumentParser()
+    parser.add_argument('sources', metavar='DIR', nargs='+',
+                        help='Man hierarchy to watch (e.g. man)')
+    parser.add_argument('-o', '--output', dest='output', metavar='DIR',
+                        help='Output directory', required=True)
+    parser.add_argument('-s', '--style', dest='style', metavar='FILE',
+                        help='Styles file (e.g. style.css)')
+    parser.add_argument('-x', '--xref', dest='xref', metavar='FILE',
+                        help='Keep a page index in FILE and link name(N) '
+                             'references only to existing pages')
+    parser.add_argument('--poll', dest='poll', metavar='SECONDS',
+                        type=float, nargs='?', const=POLL_INTERVAL,
+                        help='Poll modification times instead of using '
+                             'inotify')
+    parser.add_argument('--debounce', dest='debounce', metavar='MS',
+                        type=int, default=int(DEBOUNCE * 1000),
+                        help='Wait until changes settle for MS milliseconds')
+    args = parser.parse_args()
+    return args
+
+
+def walk_directories(sources):
+    for source in sources:
+        for directory, dirnames, _ in os.walk(source):
+            dirnames.sort()
+            yield directory
+
+
+class InotifyWatcher(object):
+    def __init__(self, sources):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.sources = sources
+        self._directories = {}
+        for directory in walk_directories(sources):
+            self._add_watch(directory)
+
+    def _add_watch(self, directory):
+        descriptor = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), WATCH_MASK)
+        if descriptor < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed',
+                          directory)
+        self._directories[descriptor] = directory
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield descriptor, mask, name
+
+    def wait(self, timeout=None):
+        changed = set()
+        while not changed:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                break
+            for descriptor, mask, name in list(self._read_events()):
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self.files())
+                    continue
+                directory = self._directories.get(descriptor)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        for new_directory in walk_directories([path]):
+                            self._add_watch(new_directory)
+                        changed.update(self.files([path]))
+                    continue
+                if not mask & IN_CREATE:
+                    changed.add(path)
+        return changed
+
+    def files(self, sources=None):
+        for directory in walk_directories(sources or self.sources):
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    yield entry.path
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    def __init__(self, sources, interval=POLL_INTERVAL):
+        self.sources = sources
+        self.interval = interval
+        self._snapshot = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+        for directory in walk_directories(self.sources):
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self.snapshot()
+            changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                       if snapshot.get(path) != self._snapshot.get(path)}
+            self._snapshot = snapshot
+            if changed:
+                return changed
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return changed
+            time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+def open_watcher(sources, poll=None):
+    if poll is None:
+        try:
+            return InotifyWatcher(sources)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(sources, poll or POLL_INTERVAL)
+
+
+def batches(watcher, debounce=DEBOUNCE):
+    pending = set()
+    while True:
+        changed = watcher.wait(debounce if pending else None)
+        if changed:
+            pending |= changed
+        elif pending:
+            yield pending
+            pending = set()
+
+
+class ReferenceRecorder(object):
+    def __init__(self, index):
+        self.index = index
+        self.fingerprint = index.fingerprint
+        self.names = set()
+
+    def resolve(self, name, section, page_path=None):
+        self.names.add(name)
+        return self.index.resolve(name, section, page_path)
+
+    def close(self):
+        self.index.close()
+
+
+def reference_name(source):
+    parts = split_page_name(strip_compression(os.path.basename(source)))
+    return None if parts is None else parts[0]
+
+
+class Reconverter(object):
+    def __init__(self, sources, output, styles='', xref_filename=None):
+        self.sources = sources
+        self.output = output
+        self.styles = styles
+        self.xref_filename = xref_filename
+        self.tasks = dict(collect_pages(sources, output))
+        self.converter = MAN2HTML()
+        self.failures = {}
+        self.index_rows = {}
+        self.references = {}
+        self.referrers = defaultdict(set)
+
+    def _index_rows(self):
+        for source in self.index_rows.keys() - self.tasks.keys():
+            del self.index_rows[source]
+        for source, target in self.tasks.items():
+            if source not in self.index_rows:
+                self.index_rows[source] = next(
+                    index_pages([(source, target)], self.output), None)
+        return [row for row in self.index_rows.values() if row is not None]
+
+    def _open_xref(self):
+        if self.xref_filename is None:
+            return
+        PageIndex.build(self.xref_filename, self._index_rows())
+        if self.converter.xref is not None:
+            self.converter.xref.close()
+        self.converter.xref = ReferenceRecorder(
+            PageIndex(self.xref_filename))
+
+    def _record_references(self, source, names):
+        for name in self.references.pop(source, ()):
+            self.referrers[name].discard(source)
+        if names:
+            self.references[source] = names
+            for name in names:
+                self.referrers[name].add(source)
+
+    def convert(self, source):
+        target = self.tasks[source]
+        xref = self.converter.xref
+        if xref is not None:
+            xref.names = set()
+        self.converter.reset(page_path=page_path(target, self.output))
+        try:
+            with open_page(source) as lines:
+                html = self.converter.man2html(lines, styles=self.styles)
+        except Exception as error:
+            self.failures[source] = '{}: {}'.format(type(error).__name__,
+                                                    error)
+            return False
+        finally:
+            if xref is not None:
+                self._record_references(source, xref.names)
+        self.failures.pop(source, None)
+        write_atomic(target, html)
+        return True
+
+    def convert_all(self):
+        self._open_xref()
+        return [source for source in sorted(self.tasks)
+                if self.convert(source)]
+
+    def update(self, paths):
+        paths = set(paths)
+        removed = {path for path in paths
+                   if path in self.tasks and not os.path.isfile(path)}
+        for source in removed:
+            self.failures.pop(source, None)
+            self._record_references(source, None)
+            if os.path.exists(self.tasks[source]):
+                os.remove(self.tasks[source])
+            del self.tasks[source]
+        added = set()
+        for path in paths - self.tasks.keys() - removed:
+            target = page_target(self.sources, path, self.output) \
+                if os.path.isfile(path) else None
+            if target is not None:
+                self.tasks[path] = target
+                added.add(path)
+        if self.xref_filename is not None and (added or removed):
+            self._open_xref()
+            for name in map(reference_name, added | removed):
+                paths |= self.referrers.get(name, set())
+        return [source for source in sorted(paths)
+                if source in self.tasks and self.convert(source)]
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+    if arguments.style:
+        with open(arguments.style) as f:
+            styles = f.read()
+    else:
+        styles = ''
+    reconverter = Reconverter(arguments.sources, arguments.output, styles,
+                              arguments.xref)
+    watcher = open_watcher(arguments.sources, arguments.poll)
+    start = time.perf_counter()
+    converted = reconverter.convert_all()
+    sys.stderr.write('converted {} pages in {:.0f} ms, watching with '
+                     '{}\n'.format(len(converted),
+                                   (time.perf_counter() - start) * 1e3,
+                                   type(watcher).__name__))
+    try:
+        for changed in batches(watcher, arguments.debounce / 1000):
+            start = time.perf_counter()
+            converted = reconverter.update(changed)
+            for source in sorted(changed):
+                if source in reconverter.failures:
+                    sys.stderr.write('{}: {}\n'.format(
+                        source, reconverter.failures[source]))
+            sys.stderr.write('converted {} pages in {:.0f} ms\n'.format(
+                len(converted), (time.perf_counter() - start) * 1e3))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
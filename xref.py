@@ -0,0 +1,80 @@
+import os
+import hashlib
+import sqlite3
+import posixpath
+
+SCHEMA = '''
+CREATE TABLE pages (
+    name TEXT NOT NULL,
+    section TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (name, section)
+) WITHOUT ROWID;
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+LOOKUP = '''
+SELECT section, path FROM pages WHERE name = ? AND section >= ? AND section < ?
+ORDER BY length(section), section
+'''
+
+
+def split_page_name(filename):
+    name, _, section = filename.rpartition('.')
+    if not name or not section[:1].isdigit():
+        return None
+    return name, section
+
+
+class PageIndex(object):
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(
+            'file:{}?mode=ro'.format(filename), uri=True,
+            check_same_thread=False)
+        self.fingerprint = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()[0]
+        self._paths = {}
+
+    @staticmethod
+    def build(filename, pages):
+        temp_filename = filename + '.tmp'
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        connection = sqlite3.connect(temp_filename)
+        digest = hashlib.sha256()
+        with connection:
+            connection.executescript(SCHEMA)
+            for name, section, path in sorted(
+                    pages, key=lambda page: (page[2].count('/'), page[2])):
+                inserted = connection.execute(
+                    'INSERT OR IGNORE INTO pages VALUES (?, ?, ?)',
+                    (name, section, path)).rowcount
+                if inserted:
+                    digest.update('{}\0{}\0{}\n'.format(
+                        name, section, path).encode('utf-8'))
+            connection.execute("INSERT INTO meta VALUES ('fingerprint', ?)",
+                               (digest.hexdigest(),))
+        connection.close()
+        os.replace(temp_filename, filename)
+
+    def lookup(self, name, section):
+        key = (name, section)
+        if key not in self._paths:
+            self._paths[key] = None
+            for candidate, path in self.connection.execute(
+                    LOOKUP, (name, section, section + '\x7f')):
+                if not candidate[len(section):][:1].isdigit():
+                    self._paths[key] = path
+                    break
+        return self._paths[key]
+
+    def resolve(self, name, section, page_path=None):
+        path = self.lookup(name, section)
+        if path is None or page_path is None:
+            return path
+        return posixpath.relpath(path, posixpath.dirname(page_path) or '.')
+
+    def close(self):
+        self.connection.close()